@@ -0,0 +1,277 @@
+"""
+Banc de charge hors ligne pour les commandes économie de coin.py.
+
+Appelle directement les coroutines des commandes (solde, daily, voler, echanger,
+classement) avec de fausses interactions Discord, sur une base eco.db temporaire.
+Mesure p50/p99, débit et commits par commande, puis vérifie la conservation des soldes.
+
+    python bench.py --users 2000 --ops 10
+    python bench.py --write-behind --max-p99 50
+    python bench.py --profile          # fonctions les plus coûteuses sur la boucle pendant la charge
+
+Code de sortie 1 si un invariant est violé ou si le p99 dépasse --max-p99 (ms) :
+utilisable comme garde-fou de régression sur les changements de stockage.
+"""
+import argparse
+import asyncio
+import cProfile
+import os
+import pstats
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+COMMANDS = ("solde", "daily", "voler", "echanger", "classement")
+GUILD_ID = 1
+WEIGHTS = (40, 10, 20, 20, 10)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Banc de charge des commandes économie")
+    parser.add_argument("--users", type=int, default=2000, help="utilisateurs simulés en parallèle")
+    parser.add_argument("--ops", type=int, default=5, help="commandes par utilisateur")
+    parser.add_argument("--population", type=int, default=10000, help="comptes déjà présents en base")
+    parser.add_argument("--calibration", type=int, default=50, help="appels séquentiels par commande pour compter les commits")
+    parser.add_argument("--write-behind", action="store_true", help="active ECO_WRITE_BEHIND")
+    parser.add_argument("--max-p99", type=float, default=None, help="échoue si un p99 dépasse cette valeur (ms)")
+    parser.add_argument("--profile", action="store_true", help="profile la charge concurrente (cProfile)")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.done = False
+
+    async def send_message(self, content=None, **kwargs):
+        self.interaction.sent.append((content, kwargs.get("embed")))
+        self.done = True
+
+    async def defer(self, **kwargs):
+        self.done = True
+
+    def is_done(self):
+        return self.done
+
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, **kwargs):
+        self.interaction.sent.append((content, kwargs.get("embed")))
+
+
+def fake_user(user_id):
+    return SimpleNamespace(id=user_id, mention=f"<@{user_id}>", avatar=None, bot=False,
+                           display_name=f"joueur{user_id}",
+                           guild_permissions=SimpleNamespace(administrator=False))
+
+
+class FakeInteraction:
+    def __init__(self, user_id, guild_id=GUILD_ID, channel_id=1):
+        self.user = fake_user(user_id)
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.guild = SimpleNamespace(id=guild_id)
+        self.sent = []
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+
+    async def delete_original_response(self):
+        pass
+
+    def embed_title(self):
+        return self.sent[-1][1].title if self.sent and self.sent[-1][1] else None
+
+
+def quantile(samples, q):
+    if not samples:
+        return 0.0
+    if len(samples) == 1:
+        return samples[0]
+    return statistics.quantiles(samples, n=100, method="inclusive")[q - 1]
+
+
+async def call(coin, name, user_id, target_id):
+    interaction = FakeInteraction(user_id)
+    if name == "solde":
+        await coin.solde.callback(interaction)
+    elif name == "daily":
+        await coin.daily.callback(interaction)
+    elif name == "voler":
+        await coin.voler.callback(interaction, fake_user(target_id))
+    elif name == "echanger":
+        await coin.echanger.callback(interaction, fake_user(target_id), random.randint(1, 50))
+    else:
+        await coin.classement.callback(interaction)
+    return interaction
+
+
+REPLAY_MISMATCHES_SQL = (
+    "SELECT COUNT(*) FROM users u LEFT JOIN (SELECT id, SUM(delta) AS total FROM ("
+    " SELECT to_id AS id, amount AS delta FROM ledger WHERE guild_id = ? AND to_id IS NOT NULL"
+    " UNION ALL SELECT from_id, -amount FROM ledger WHERE guild_id = ? AND from_id IS NOT NULL"
+    ") GROUP BY id) l ON l.id = u.id WHERE u.guild_id = ? AND u.balance != COALESCE(l.total, 0)")
+
+
+async def shutdown_during_flush(coin, ids):
+    """
+    Arrêt (SIGTERM) pendant un vidage de fond : les écritures en cours sont ralenties,
+    un tick est réveillé, puis close_economy() est appelé pendant que ce tick écrit.
+    Les transferts conservent la somme des soldes : seul le journal permet de voir une perte.
+    """
+    def slowed(write):
+        async def slow(conn, rows):
+            await asyncio.sleep(1)
+            await write(conn, rows)
+        return staticmethod(slow)
+
+    for _ in range(20):
+        await coin.transfer(GUILD_ID, random.choice(ids), random.choice(ids), 1)
+    coin.Ledger._write = slowed(coin.Ledger._write)
+    coin.BalanceCache._write = slowed(coin.BalanceCache._write)
+    coin.ledger._wakeup.set()
+    coin.balance_cache._wakeup.set()
+    await asyncio.sleep(0.05)
+    await coin.close_economy()
+
+
+async def run(args):
+    import coin
+
+    random.seed(args.seed)
+    coin.loop_monitor.start()
+    await coin.open_guild(GUILD_ID)
+    # Base du serveur : la base partagée, ou guilds/<id>.db avec ECO_DB_PER_GUILD=1
+    store = coin.guild_db(GUILD_ID)
+    async with store.write() as conn:
+        await conn.executemany("INSERT INTO users (guild_id, id, balance) VALUES (?, ?, ?)",
+                               [(GUILD_ID, 10**9 + i, random.randint(0, 5000)) for i in range(args.population)])
+        # La population existait avant le journal : mêmes écritures d'ouverture que la migration du schéma
+        await conn.execute("INSERT INTO ledger (ts, guild_id, actor, from_id, to_id, amount, action) "
+                           "SELECT ?, guild_id, NULL, NULL, id, balance, 'ouverture' FROM users WHERE balance > 0",
+                           (time.time(),))
+    # Index en mémoire chargés sur une base vide par open_guild : on les recharge avec la population
+    if coin.WRITE_BEHIND:
+        await coin.balance_cache.load(GUILD_ID)
+    await coin.get_leaderboard(GUILD_ID).load()
+    # On mesure le stockage, pas les règles du jeu : pas de délai ni de limite journalière
+    for key in ("daily_cooldown", "vol_cooldown", "echange_cooldown"):
+        await coin.set_config(GUILD_ID, key, 0)
+    for key in ("vols_max_per_day", "echanges_max_per_day"):
+        await coin.set_config(GUILD_ID, key, 10**9)
+    initial_total = (await store.fetchone("SELECT COALESCE(SUM(balance), 0) FROM users"))[0]
+    initial_users = (await store.fetchone("SELECT COUNT(*) FROM users"))[0]
+    ids = [i + 1 for i in range(args.users)]
+
+    # Calibration séquentielle : commits attribuables à chaque commande
+    commits = {}
+    for name in COMMANDS:
+        before = store.commits
+        for _ in range(args.calibration):
+            await call(coin, name, random.choice(ids), random.choice(ids))
+        commits[name] = (store.commits - before) / args.calibration
+
+    # Charge concurrente
+    latencies = {name: [] for name in COMMANDS}
+    dailies = 0
+
+    async def simulated_user(user_id):
+        nonlocal dailies
+        for _ in range(args.ops):
+            name = random.choices(COMMANDS, WEIGHTS)[0]
+            target = random.choice(ids)
+            start = time.perf_counter()
+            interaction = await call(coin, name, user_id, target)
+            latencies[name].append((time.perf_counter() - start) * 1000)
+            if name == "daily" and interaction.embed_title():
+                dailies += 1
+
+    commits_before = store.commits
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    start = time.perf_counter()
+    await asyncio.gather(*(simulated_user(uid) for uid in ids))
+    elapsed = time.perf_counter() - start
+    if profiler:
+        profiler.disable()
+    load_commits = store.commits - commits_before
+
+    # Invariants : le journal rejoue exactement les soldes, et l'argent n'apparaît que par daily/création
+    mismatches = await coin.replay_ledger(GUILD_ID)
+    calibration_dailies = (await store.fetchone("SELECT COUNT(*) FROM ledger WHERE action = 'daily'"))[0] - dailies
+    path = store.path
+    await shutdown_during_flush(coin, ids)
+    coin.loop_monitor.stop()
+
+    conn = sqlite3.connect(path)
+    final_total, final_users, negatives = conn.execute(
+        "SELECT SUM(balance), COUNT(*), SUM(balance < 0) FROM users").fetchone()
+    # Après l'arrêt, le journal en base doit toujours rejouer les soldes en base
+    shutdown_mismatches = conn.execute(REPLAY_MISMATCHES_SQL, (GUILD_ID, GUILD_ID, GUILD_ID)).fetchone()[0]
+    conn.close()
+    daily_amount = coin.get_config(GUILD_ID, "daily_amount")
+    expected_total = (initial_total + (final_users - initial_users) * coin.STARTING_BALANCE
+                      + (dailies + calibration_dailies) * daily_amount)
+
+    total_ops = sum(len(v) for v in latencies.values())
+    mode = "write-behind" if coin.WRITE_BEHIND else "écriture directe"
+    print(f"Mode : {mode} — {args.users} utilisateurs × {args.ops} commandes, population {args.population}")
+    print(f"{'commande':<12}{'appels':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}{'commits':>10}")
+    worst_p99 = 0.0
+    for name in COMMANDS:
+        samples = latencies[name]
+        p99 = quantile(samples, 99)
+        worst_p99 = max(worst_p99, p99)
+        print(f"{name:<12}{len(samples):>8}{quantile(samples, 50):>10.2f}{p99:>10.2f}"
+              f"{max(samples, default=0):>10.2f}{commits[name]:>10.2f}")
+    print(f"Débit : {total_ops / elapsed:.0f} commandes/s ({total_ops} en {elapsed:.2f}s)")
+    print(f"Commits pendant la charge : {load_commits} ({load_commits / max(total_ops, 1):.3f} par commande)")
+    held = sum(coin.metrics.count("eco_loop_held_total", name) for name in COMMANDS)
+    print(f"Boucle : retard max {coin.loop_monitor.max_lag * 1000:.1f} ms, "
+          f"{held} tranche(s) de handler > {coin.LOOP_HOLD_WARN * 1000:.0f} ms")
+    deferred = sum(coin.metrics.count("eco_responses_deferred_total", name) for name in COMMANDS)
+    print(f"Réponses différées (au-delà de {coin.RESPONSE_BUDGET * 1000:.0f} ms) : {deferred}")
+    if profiler:
+        pstats.Stats(profiler).sort_stats("tottime").print_stats(15)
+
+    failures = []
+    if mismatches:
+        failures.append(f"{len(mismatches)} soldes divergent du journal")
+    if shutdown_mismatches:
+        failures.append(f"{shutdown_mismatches} soldes divergent du journal après un arrêt pendant un vidage")
+    if final_total != expected_total:
+        failures.append(f"somme des soldes {final_total} ≠ attendu {expected_total}")
+    if negatives:
+        failures.append(f"{negatives} soldes négatifs")
+    if args.max_p99 is not None and worst_p99 > args.max_p99:
+        failures.append(f"p99 {worst_p99:.2f} ms > {args.max_p99} ms")
+    for failure in failures:
+        print(f"ÉCHEC : {failure}")
+    if not failures:
+        print("Invariants OK : conservation des soldes, journal cohérent, aucun solde négatif")
+    return 1 if failures else 0
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="eco-bench-")
+    os.environ["ECO_DB"] = os.path.join(workdir, "eco.db")
+    os.environ["ECO_GUILD_DB_DIR"] = os.path.join(workdir, "guilds")
+    # Tous les joueurs simulés partagent un salon : la limite d'envoi vers Discord fausserait les latences
+    os.environ.setdefault("ECO_CHANNEL_RATE", "0")
+    os.environ.setdefault("ECO_GUILD_RATE", "0")
+    if args.write_behind:
+        os.environ["ECO_WRITE_BEHIND"] = "1"
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
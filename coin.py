@@ -1,25 +1,844 @@
+import time
+# Avant les imports lourds : le rapport de démarrage compte aussi leur durée
+_STARTED = time.perf_counter()
 import discord
 from discord import app_commands
 from discord.ext import commands
-import aiosqlite
+try:
+    import aiosqlite
+except ImportError:  # repli sur sqlite3 (voir SyncConnection)
+    aiosqlite = None
+import argparse
+import asyncio
+import contextvars
+import functools
+import gzip
+import hashlib
+import json
+import bisect
+import heapq
 import random
-from datetime import datetime
+import sqlite3
+import types
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+import math
 import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
 
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix="!", intents=intents)
+# Intent privilégié (à activer aussi dans le portail développeur) : nécessaire pour cibler un rôle avec /masse
+intents.members = os.getenv("ECO_MEMBERS_INTENT", "0") == "1"
+
+
+# Sharding automatique : discord.py choisit le nombre de shards recommandé par la gateway
+class EcoBot(commands.AutoShardedBot):
+    async def setup_hook(self):
+        # Une seule fois par processus, avant la gateway : les reconnexions ne refont ni migrations ni sync
+        startup.mark("connexion")
+        await open_economy()
+        synced = await sync_commands()
+        startup.mark("sync" if synced else "sync (inchangé)")
+
+    async def close(self):
+        await super().close()
+        await close_economy()
+
+
+bot = EcoBot(command_prefix="!", intents=intents)
 tree = bot.tree
 
-# --------- DATABASE INIT ----------
-async def init_db():
-    async with aiosqlite.connect("eco.db") as db:
-        await db.execute("CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, balance INTEGER)")
-        await db.execute("CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT)")
-        await db.execute("""CREATE TABLE IF NOT EXISTS quotas (
-            user_id INTEGER, action TEXT, count INTEGER, date TEXT,
-            PRIMARY KEY (user_id, action, date))""")
-        await db.commit()
+# --------- INSTRUMENTATION ----------
+# Discord invalide une interaction sans réponse après 3 secondes
+INTERACTION_DEADLINE = 3.0
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 3.0, 5.0, 10.0)
+
+# Commande en cours d'exécution dans la tâche courante (pour attribuer requêtes et commits)
+current_command = contextvars.ContextVar("current_command", default="arriere_plan")
+_command_started = contextvars.ContextVar("command_started", default=None)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS, keep=512):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=keep)
+
+    def observe(self, value):
+        self.total += 1
+        self.sum += value
+        self.recent.append(value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def quantile(self, q):
+        # Approximé sur les derniers échantillons, suffisant pour /stats
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class Metrics:
+    """
+    Compteurs et histogrammes en mémoire, exposés au format texte Prometheus
+    (route /metrics) et résumés par la commande /stats. Le verrou protège la
+    lecture depuis le thread HTTP.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = defaultdict(Histogram)
+        self.responses = defaultdict(Histogram)
+        self.helpers = defaultdict(Histogram)
+        self.counters = defaultdict(int)
+
+    def inc(self, name, label, value=1):
+        with self.lock:
+            self.counters[(name, label)] += value
+
+    def observe(self, family, label, value):
+        with self.lock:
+            family[label].observe(value)
+
+    def count(self, name, label):
+        return self.counters.get((name, label), 0)
+
+    def total(self, name):
+        with self.lock:
+            return sum(value for (counter, _), value in self.counters.items() if counter == name)
+
+    def render(self):
+        # Copie rapide sous verrou, mise en forme ensuite : la boucle du bot n'attend jamais le thread HTTP
+        with self.lock:
+            families = [
+                (metric, label_name, help_text,
+                 [(label, hist.buckets, list(hist.counts), hist.total, hist.sum) for label, hist in family.items()])
+                for metric, family, label_name, help_text in (
+                    ("eco_command_duration_seconds", self.durations, "command", "Durée totale du handler"),
+                    ("eco_command_response_seconds", self.responses, "command", "Délai avant la première réponse"),
+                    ("eco_db_helper_duration_seconds", self.helpers, "helper", "Durée des helpers base de données"))]
+            counters = dict(self.counters)
+        lines = []
+        for metric, label_name, help_text, hists in families:
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} histogram")
+            for label, buckets, counts, total, total_sum in sorted(hists):
+                for bound, count in zip(buckets, counts):
+                    lines.append(f'{metric}_bucket{{{label_name}="{label}",le="{bound}"}} {count}')
+                lines.append(f'{metric}_bucket{{{label_name}="{label}",le="+Inf"}} {total}')
+                lines.append(f'{metric}_sum{{{label_name}="{label}"}} {total_sum:.6f}')
+                lines.append(f'{metric}_count{{{label_name}="{label}"}} {total}')
+        names = sorted({name for name, _ in counters})
+        for name in names:
+            lines.append(f"# TYPE {name} counter")
+            for (counter, label), value in sorted(counters.items()):
+                if counter == name:
+                    lines.append(f'{name}{{command="{label}"}} {value}')
+        # Hors verrou, ces dictionnaires appartiennent à la boucle du bot : on les copie avant de les parcourir
+        # (un serveur ouvert pendant le parcours lèverait « dictionary changed size during iteration »)
+        for key, value in list(balance_cache.stats.items()):
+            lines.append(f"eco_write_behind_{key} {value}")
+        lines.append(f"eco_ledger_queue {len(ledger.queue)}")
+        lines.append(f"eco_leaderboard_players {sum(len(board.keys) for board in list(leaderboards.values()))}")
+        lines.append(f"eco_guilds_open {len(_open_guilds)}")
+        lines.append(f"eco_event_loop_lag_seconds {loop_monitor.lag:.6f}")
+        lines.append(f"eco_event_loop_lag_max_seconds {loop_monitor.max_lag:.6f}")
+        for phase, seconds in list(startup.phases.items()):
+            lines.append(f'eco_startup_seconds{{phase="{phase}"}} {seconds:.6f}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+def instrument(func):
+    """Mesure un handler de commande : durée, délai de réponse, erreurs, requêtes et commits."""
+    @functools.wraps(func)
+    async def wrapper(interaction, *args, **kwargs):
+        name = func.__name__
+        token = current_command.set(name)
+        started = _command_started.set(time.perf_counter())
+        reply = _Reply()
+        reply_token = _reply.set(reply)
+        # Base lente ou boucle chargée : defer avant l'expiration, la réponse suivra en followup
+        timer = asyncio.get_running_loop().call_later(RESPONSE_BUDGET, _defer_late, interaction, reply)
+        start = time.perf_counter()
+        try:
+            if interaction.guild_id is not None:
+                # Premier usage sur ce serveur : charge sa config et ses caches (sous le minuteur, gros serveurs compris)
+                await open_guild(interaction.guild_id)
+            return await loop_monitor.track(func(interaction, *args, **kwargs), name)
+        except Exception:
+            metrics.inc("eco_command_errors_total", name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.observe(metrics.durations, name, elapsed)
+            metrics.inc("eco_commands_total", name)
+            if elapsed > INTERACTION_DEADLINE:
+                metrics.inc("eco_command_over_deadline_total", name)
+            timer.cancel()
+            current_command.reset(token)
+            _command_started.reset(started)
+            _reply.reset(reply_token)
+    return wrapper
+
+def timed(func):
+    """Mesure la durée d'un helper base de données."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            metrics.observe(metrics.helpers, func.__name__, time.perf_counter() - start)
+    return wrapper
+
+# Au-delà, un handler qui garde la boucle sans rendre la main est signalé dans les logs
+LOOP_HOLD_WARN = int(os.getenv("ECO_LOOP_HOLD_WARN_MS", "50")) / 1000
+
+
+class LoopMonitor:
+    """
+    Mesure le retard de la boucle asyncio (un sleep qui se réveille en retard = boucle bloquée)
+    et, pour chaque handler suivi par track(), le temps passé sans rendre la main entre deux await.
+    """
+
+    def __init__(self, interval=0.5, hold_warn=LOOP_HOLD_WARN):
+        self.interval = interval
+        self.hold_warn = hold_warn
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.in_flight = {}
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lag = max(loop.time() - expected, 0.0)
+            self.max_lag = max(self.max_lag, self.lag)
+            if self.lag > self.hold_warn and self.in_flight:
+                running = ", ".join(f"/{name}" for name in sorted(set(self.in_flight.values())))
+                print(f"Boucle en retard de {self.lag * 1000:.0f} ms, handlers en cours : {running}")
+
+    @types.coroutine
+    def track(self, coro, name):
+        """Exécute coro pas à pas en chronométrant chaque tranche synchrone (entre deux await)."""
+        self.in_flight[id(coro)] = name
+        value, error = None, None
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    step = coro.throw(error) if error is not None else coro.send(value)
+                except StopIteration as stop:
+                    return stop.value
+                finally:
+                    held = time.perf_counter() - start
+                    if held > self.hold_warn:
+                        metrics.inc("eco_loop_held_total", name)
+                        print(f"/{name} a bloqué la boucle {held * 1000:.0f} ms sans rendre la main")
+                try:
+                    value, error = (yield step), None
+                except BaseException as exc:
+                    value, error = None, exc
+        finally:
+            del self.in_flight[id(coro)]
+            coro.close()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+loop_monitor = LoopMonitor()
+
+
+class StartupReport:
+    """Durée de chaque étape du démarrage (et des reconnexions), affichée une fois prête et exposée sur /metrics."""
+
+    def __init__(self, started):
+        self.started = started
+        self.phases = {}
+        self._last = started
+        self.disconnected_at = None
+
+    def mark(self, phase):
+        # Temps écoulé depuis l'étape précédente
+        now = time.perf_counter()
+        self.phases[phase] = now - self._last
+        self._last = now
+
+    def report(self):
+        total = time.perf_counter() - self.started
+        steps = " · ".join(f"{phase} {seconds * 1000:.0f} ms" for phase, seconds in self.phases.items())
+        print(f"Démarrage en {total:.2f}s : {steps}")
+
+    def disconnected(self):
+        if self.disconnected_at is None:
+            self.disconnected_at = time.perf_counter()
+
+    def reconnected(self):
+        if self.disconnected_at is None:
+            return
+        elapsed = time.perf_counter() - self.disconnected_at
+        self.disconnected_at = None
+        self.phases["reconnexion"] = elapsed
+        print(f"Reconnecté en {elapsed:.2f}s")
+
+
+startup = StartupReport(_STARTED)
+
+# --------- RÉPONSES (délai, limite d'envoi) ----------
+# Sans réponse après ce délai, la commande est différée (defer) et sa réponse partira en followup
+RESPONSE_BUDGET = int(os.getenv("ECO_RESPONSE_BUDGET_MS", "1500")) / 1000
+# Seaux de jetons : réponses par seconde et rafale par salon et par serveur. Désactivés par défaut (débit 0) :
+# la limite de Discord sur les réponses d'interaction est large, et un seau trop serré retarde chaque réponse
+# d'un pic (/daily à la remise à zéro) bien plus que Discord ne le ferait. À activer si les 429 apparaissent,
+# par exemple ECO_CHANNEL_RATE=5 ECO_GUILD_RATE=20
+CHANNEL_RATE = float(os.getenv("ECO_CHANNEL_RATE", "0"))
+CHANNEL_BURST = int(os.getenv("ECO_CHANNEL_BURST", "20"))
+GUILD_RATE = float(os.getenv("ECO_GUILD_RATE", "0"))
+GUILD_BURST = int(os.getenv("ECO_GUILD_BURST", "50"))
+RATE_BUCKETS_MAX = 4096
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now):
+        """Prend un jeton, quitte à passer en négatif ; renvoie l'attente en secondes avant de l'utiliser."""
+        self.refill(now)
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class ResponseLimiter:
+    """
+    Un seau par salon et un par serveur : une réponse attend que les deux aient un jeton.
+    Les jetons sont réservés à l'arrivée, donc les réponses en attente partent dans l'ordre.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+
+    def _bucket(self, key, rate, burst):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= RATE_BUCKETS_MAX:
+                self._prune()
+            bucket = self.buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    def _prune(self):
+        # Un seau redevenu plein ne sert plus à rien : il sera recréé plein au prochain message
+        now = time.monotonic()
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self.buckets[key]
+
+    def reserve(self, guild_id, channel_id):
+        now = time.monotonic()
+        wait = 0.0
+        for key, rate, burst in ((("salon", channel_id), CHANNEL_RATE, CHANNEL_BURST),
+                                 (("serveur", guild_id), GUILD_RATE, GUILD_BURST)):
+            if rate > 0 and key[1] is not None:
+                wait = max(wait, self._bucket(key, rate, burst).reserve(now))
+        return wait
+
+
+response_limiter = ResponseLimiter()
+
+
+class _Reply:
+    """Réponse en cours d'une commande : defer lancé (tâche), avec quelle visibilité, et ce qui est déjà parti."""
+    __slots__ = ("defer", "ephemeral", "replied", "followed")
+
+    def __init__(self):
+        self.defer = None
+        self.ephemeral = False
+        self.replied = False
+        self.followed = False
+
+
+_reply = contextvars.ContextVar("reply", default=None)
+
+async def _defer(interaction, reply, ephemeral):
+    reply.ephemeral = ephemeral
+    metrics.inc("eco_responses_deferred_total", current_command.get())
+    started = _command_started.get()
+    if started is not None:
+        metrics.observe(metrics.responses, current_command.get(), time.perf_counter() - started)
+    await interaction.response.defer(ephemeral=ephemeral)
+
+def _defer_late(interaction, reply):
+    # Appelé par le minuteur de instrument : la commande n'a toujours rien envoyé
+    if not reply.replied and reply.defer is None and not interaction.response.is_done():
+        reply.defer = asyncio.ensure_future(_defer(interaction, reply, False))
+
+async def respond(interaction, content=None, **kwargs):
+    """
+    Envoie la réponse d'une commande (send_message, ou followup si elle a déjà été différée).
+    Passe d'abord par les seaux du salon et du serveur : s'il faut attendre un jeton,
+    l'interaction est différée tout de suite pour ne pas expirer pendant l'attente.
+    """
+    reply = _reply.get() or _Reply()
+    ephemeral = kwargs.get("ephemeral", False)
+    # Une réponse éphémère ne s'affiche pas dans le salon : seul le seau du serveur la compte
+    wait = response_limiter.reserve(interaction.guild_id, None if ephemeral else interaction.channel_id)
+    if wait:
+        metrics.inc("eco_responses_limited_total", current_command.get())
+        if reply.defer is None and not interaction.response.is_done():
+            reply.defer = asyncio.ensure_future(_defer(interaction, reply, ephemeral))
+        await asyncio.sleep(wait)
+    # Le minuteur de instrument ne diffère plus une réponse déjà en route
+    reply.replied = True
+    if reply.defer is not None:
+        await reply.defer
+    if not interaction.response.is_done():
+        started = _command_started.get()
+        if started is not None:
+            metrics.observe(metrics.responses, current_command.get(), time.perf_counter() - started)
+        await interaction.response.send_message(content, **kwargs)
+        return
+    if reply.defer is not None and not reply.followed and ephemeral and not reply.ephemeral:
+        # La première suite remplace le message différé, public : on le retire pour rester privé
+        await interaction.delete_original_response()
+    reply.followed = True
+    await interaction.followup.send(content, **kwargs)
+
+# --------- EXÉCUTEUR ----------
+# Threads pour le travail bloquant (calculs sur toute une table, exports) : la gateway garde ses heartbeats
+OFFLOAD_WORKERS = int(os.getenv("ECO_OFFLOAD_WORKERS", "2"))
+# En dessous de ce nombre de lignes, passer par un thread coûte plus cher que le calcul lui-même
+OFFLOAD_MIN_ROWS = int(os.getenv("ECO_OFFLOAD_MIN_ROWS", "5000"))
+
+executor = ThreadPoolExecutor(max_workers=OFFLOAD_WORKERS, thread_name_prefix="eco-offload")
+
+async def offload(func, *args, **kwargs):
+    """Exécute func dans le pool de threads et mesure sa durée comme un helper."""
+    start = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(func, *args, **kwargs))
+    finally:
+        metrics.observe(metrics.helpers, f"offload_{func.__name__}", time.perf_counter() - start)
+
+# --------- DATABASE ----------
+DB_PATH = os.getenv("ECO_DB", "eco.db")
+DB_READERS = int(os.getenv("ECO_DB_READERS", "4"))
+# Une base SQLite par serveur : les verrous d'écriture d'un serveur actif ne bloquent plus les autres
+DB_PER_GUILD = os.getenv("ECO_DB_PER_GUILD", "0") == "1"
+GUILD_DB_DIR = os.getenv("ECO_GUILD_DB_DIR", "guilds")
+GUILD_DB_READERS = int(os.getenv("ECO_GUILD_DB_READERS", "1"))
+# "sqlite3" force le pilote de repli, utilisé d'office si aiosqlite n'est pas installé
+DB_DRIVER = os.getenv("ECO_DB_DRIVER", "aiosqlite" if aiosqlite is not None else "sqlite3")
+
+# Réglages appliqués à chaque connexion (WAL : les lectures ne bloquent plus l'écrivain)
+DB_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+    "PRAGMA mmap_size=67108864",
+)
+
+
+class Database:
+    """
+    Connexions ouvertes pour toute la durée de vie du bot :
+    un seul écrivain (sérialisé par un verrou) et un petit pool de lecteurs.
+    """
+
+    def __init__(self, path, readers=DB_READERS):
+        self.path = path
+        self.readers = max(readers, 1)
+        self.writer = None
+        self._write_lock = asyncio.Lock()
+        self._pool = None
+        self._read_conns = []
+        self.commits = 0
+
+    @property
+    def is_open(self):
+        return self.writer is not None
+
+    async def _connect(self, query_only=False):
+        if DB_DRIVER == "sqlite3":
+            conn = await SyncConnection.connect(self.path)
+        else:
+            conn = await aiosqlite.connect(self.path, isolation_level=None)
+        for pragma in DB_PRAGMAS + (("PRAGMA query_only=ON",) if query_only else ()):
+            # Certains PRAGMA renvoient une ligne : on ferme le curseur pour ne garder aucun verrou
+            async with conn.execute(pragma):
+                pass
+        return conn
+
+    async def open(self):
+        if self.is_open:
+            return
+        self.writer = await self._connect()
+        async with self.writer.execute("PRAGMA journal_mode=WAL"):
+            pass
+        self._pool = asyncio.Queue()
+        for _ in range(self.readers):
+            conn = await self._connect(query_only=True)
+            self._read_conns.append(conn)
+            self._pool.put_nowait(conn)
+
+    async def close(self):
+        if not self.is_open:
+            return
+        async with self._write_lock:
+            for conn in self._read_conns:
+                await conn.close()
+            async with self.writer.execute("PRAGMA optimize"):
+                pass
+            await self.writer.close()
+            self.writer = None
+            self._read_conns = []
+            self._pool = None
+
+    def count_statement(self, commit=False):
+        name = current_command.get()
+        metrics.inc("eco_db_statements_total", name)
+        if commit:
+            self.commits += 1
+            metrics.inc("eco_db_commits_total", name)
+
+    async def fetchone(self, sql, params=()):
+        self.count_statement()
+        async with self.read() as conn:
+            async with conn.execute(sql, params) as cursor:
+                return await cursor.fetchone()
+
+    async def fetchall(self, sql, params=()):
+        self.count_statement()
+        async with self.read() as conn:
+            async with conn.execute(sql, params) as cursor:
+                return await cursor.fetchall()
+
+    @asynccontextmanager
+    async def read(self):
+        conn = await self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put_nowait(conn)
+
+    @asynccontextmanager
+    async def write(self):
+        async with self._write_lock:
+            # IMMEDIATE : le verrou d'écriture est pris dès le début, pas au premier UPDATE
+            await self.writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield CountingConnection(self.writer, self)
+            except BaseException:
+                await self.writer.rollback()
+                raise
+            await self.writer.commit()
+            self.count_statement(commit=True)
+
+
+class CountingConnection:
+    """Connexion d'écriture qui compte chaque requête envoyée pour l'instrumentation."""
+
+    def __init__(self, conn, database):
+        self._conn = conn
+        self._db = database
+
+    def execute(self, sql, params=None):
+        self._db.count_statement()
+        return self._conn.execute(sql, params)
+
+    def executemany(self, sql, params):
+        self._db.count_statement()
+        return self._conn.executemany(sql, params)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class SyncConnection:
+    """
+    Pilote de repli sans aiosqlite : une connexion sqlite3 et son thread dédié.
+    Expose le sous-ensemble d'API utilisé ici (execute en await ou en async with,
+    executemany, commit, rollback, close) pour que Database ne voie pas la différence.
+    """
+
+    def __init__(self, conn, thread):
+        self._conn = conn
+        self._thread = thread
+
+    @classmethod
+    async def connect(cls, path):
+        # Un thread par connexion : sqlite3 n'est jamais utilisé depuis deux threads à la fois
+        thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="eco-sqlite")
+        conn = await asyncio.get_running_loop().run_in_executor(
+            thread, functools.partial(sqlite3.connect, path, isolation_level=None, check_same_thread=False))
+        return cls(conn, thread)
+
+    def _run(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self._thread, functools.partial(func, *args))
+
+    def execute(self, sql, params=None):
+        return _SyncResult(self, self._conn.execute, sql, params or ())
+
+    def executemany(self, sql, params):
+        return _SyncResult(self, self._conn.executemany, sql, list(params))
+
+    async def commit(self):
+        await self._run(self._conn.commit)
+
+    async def rollback(self):
+        await self._run(self._conn.rollback)
+
+    async def close(self):
+        await self._run(self._conn.close)
+        self._thread.shutdown(wait=False)
+
+
+class _SyncResult:
+    """Résultat de SyncConnection.execute : awaitable, ou context manager qui ferme le curseur."""
+
+    def __init__(self, connection, func, *args):
+        self._connection = connection
+        self._call = (func, *args)
+        self._cursor = None
+
+    async def _start(self):
+        cursor = await self._connection._run(*self._call)
+        return _SyncCursor(self._connection, cursor)
+
+    def __await__(self):
+        return self._start().__await__()
+
+    async def __aenter__(self):
+        self._cursor = await self._start()
+        return self._cursor
+
+    async def __aexit__(self, *exc):
+        await self._cursor.close()
+
+
+class _SyncCursor:
+    def __init__(self, connection, cursor):
+        self._connection = connection
+        self._cursor = cursor
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    async def fetchone(self):
+        return await self._connection._run(self._cursor.fetchone)
+
+    async def fetchall(self):
+        return await self._connection._run(self._cursor.fetchall)
+
+    async def close(self):
+        await self._connection._run(self._cursor.close)
+
+
+db = Database(DB_PATH)
+# Bases par serveur (ECO_DB_PER_GUILD), ouvertes au premier usage du serveur
+guild_dbs = {}
+
+def guild_db(guild_id):
+    return guild_dbs.get(guild_id, db) if DB_PER_GUILD else db
+
+def databases():
+    return [db] + list(guild_dbs.values())
+
+def group_by_database(rows):
+    """Répartit des lignes (guild_id en tête) par base : une seule en mode partagé, une par serveur sinon."""
+    groups = defaultdict(list)
+    for row in rows:
+        groups[guild_db(row[0])].append(row)
+    return groups
+
+
+class BackgroundWriter:
+    """
+    Base des caches mémoire écrits en différé : une tâche de fond appelle tick()
+    à intervalle régulier, et stop() fait un dernier flush avant la fermeture de la base.
+    """
+
+    name = "Cache"
+    interval = 1
+
+    def __init__(self):
+        self.loaded = False
+        self._task = None
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+
+    async def flush(self):
+        # Un seul vidage à la fois : un appelant qui attend voit aussi les lignes du vidage en cours
+        async with self._flush_lock:
+            return await self._flush()
+
+    async def _flush(self):
+        raise NotImplementedError
+
+    async def tick(self):
+        await self.flush()
+
+    async def write_grouped(self, rows, write, requeue):
+        """
+        Écrit les lignes base par base avec write(conn, lignes) ;
+        en cas d'échec, requeue reçoit toutes les lignes pas encore écrites.
+        """
+        groups = list(group_by_database(rows).items())
+        for i, (database, group) in enumerate(groups):
+            try:
+                async with database.write() as conn:
+                    await write(conn, group)
+            except BaseException:
+                # BaseException : une annulation (arrêt du bot) annule aussi la transaction, les lignes doivent revenir
+                requeue([row for _, pending in groups[i:] for row in pending])
+                raise
+
+    async def wait(self):
+        # Réveil à l'intervalle, ou plus tôt si un cache plein appelle self._wakeup.set()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def _run(self):
+        while True:
+            await self.wait()
+            try:
+                await self.tick()
+            except Exception as e:
+                print(f"{self.name} : échec de l'écriture en différé ({e}), nouvel essai au prochain cycle")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            # Jamais d'annulation au milieu d'un vidage : on attend qu'il se termine, puis la tâche s'arrête
+            async with self._flush_lock:
+                self._task.cancel()
+                try:
+                    await self._task
+                except asyncio.CancelledError:
+                    pass
+            self._task = None
+        if self.loaded and db.is_open:
+            await self.flush()
+
+# Tables dont les lignes appartiennent à un serveur, avec leurs colonnes hors guild_id
+GUILD_TABLES = {
+    "users": ("id", "balance"),
+    "config": ("key", "value"),
+    "quotas": ("user_id", "action", "count", "date"),
+    "cooldowns": ("user_id", "action", "expires_at"),
+    "ledger": ("id", "ts", "actor", "from_id", "to_id", "amount", "action"),
+}
+# Les données d'avant le multi-serveur sont rangées sous ce serveur fictif, puis rattachées (voir _adopt_legacy)
+LEGACY_GUILD = 0
+
+
+async def _table_columns(conn, table):
+    async with conn.execute(f"PRAGMA table_info({table})") as cursor:
+        return {row[1] for row in await cursor.fetchall()}
+
+async def _migrate_guild_schema(conn):
+    """v1 : tables par serveur, journal et index ; reprend aussi les bases d'avant le suivi des versions."""
+    # Anciennes bases mono-serveur : la clé primaire change, on reconstruit ces tables
+    legacy = []
+    for table in ("users", "config", "quotas", "cooldowns"):
+        columns = await _table_columns(conn, table)
+        if columns and "guild_id" not in columns:
+            await conn.execute(f"ALTER TABLE {table} RENAME TO {table}_legacy")
+            legacy.append(table)
+    columns = await _table_columns(conn, "ledger")
+    if columns and "guild_id" not in columns:
+        await conn.execute(f"ALTER TABLE ledger ADD COLUMN guild_id INTEGER NOT NULL DEFAULT {LEGACY_GUILD}")
+    await conn.execute("""CREATE TABLE IF NOT EXISTS users (
+        guild_id INTEGER, id INTEGER, balance INTEGER,
+        PRIMARY KEY (guild_id, id))""")
+    await conn.execute("""CREATE TABLE IF NOT EXISTS config (
+        guild_id INTEGER, key TEXT, value TEXT,
+        PRIMARY KEY (guild_id, key))""")
+    await conn.execute("""CREATE TABLE IF NOT EXISTS quotas (
+        guild_id INTEGER, user_id INTEGER, action TEXT, count INTEGER, date TEXT,
+        PRIMARY KEY (guild_id, user_id, action, date))""")
+    await conn.execute("""CREATE TABLE IF NOT EXISTS cooldowns (
+        guild_id INTEGER, user_id INTEGER, action TEXT, expires_at REAL,
+        PRIMARY KEY (guild_id, user_id, action))""")
+    await conn.execute("""CREATE TABLE IF NOT EXISTS ledger (
+        id INTEGER PRIMARY KEY, ts REAL, actor INTEGER,
+        from_id INTEGER, to_id INTEGER, amount INTEGER, action TEXT,
+        guild_id INTEGER NOT NULL DEFAULT 0)""")
+    for table in legacy:
+        columns = ", ".join(GUILD_TABLES[table])
+        # OR REPLACE dans l'ordre des rowid : les doublons de l'ancienne table users gardent la dernière ligne
+        await conn.execute(f"INSERT OR REPLACE INTO {table} (guild_id, {columns}) "
+                           f"SELECT ?, {columns} FROM {table}_legacy ORDER BY rowid", (LEGACY_GUILD,))
+        await conn.execute(f"DROP TABLE {table}_legacy")
+    # Premier démarrage avec le journal : les soldes existants deviennent des écritures d'ouverture
+    await conn.execute("""INSERT INTO ledger (ts, guild_id, actor, from_id, to_id, amount, action)
+        SELECT ?, guild_id, NULL, NULL, id, balance, 'ouverture' FROM users
+        WHERE balance > 0 AND NOT EXISTS (SELECT 1 FROM ledger)""", (time.time(),))
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_balance ON users(guild_id, balance DESC, id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_quotas_date ON quotas(date)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_ledger_guild ON ledger(guild_id)")
+
+async def _migrate_meta(conn):
+    """v2 : petites valeurs techniques (empreinte des commandes synchronisées, ...)."""
+    await conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+# Migrations dans l'ordre : PRAGMA user_version retient le numéro de la dernière appliquée.
+# Une nouvelle migration s'ajoute à la fin, les précédentes ne sont jamais modifiées.
+MIGRATIONS = [_migrate_guild_schema, _migrate_meta]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+@timed
+async def init_db(database=db):
+    """Applique les migrations manquantes ; sur une base à jour, ce n'est qu'une lecture de user_version."""
+    version = (await database.fetchone("PRAGMA user_version"))[0]
+    if version >= SCHEMA_VERSION:
+        return version
+    async with database.write() as conn:
+        async with conn.execute("PRAGMA user_version") as cursor:
+            version = (await cursor.fetchone())[0]
+        for migration in MIGRATIONS[version:]:
+            await migration(conn)
+        await conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    if version < SCHEMA_VERSION:
+        print(f"Schéma {database.path} : migrations {version + 1} à {SCHEMA_VERSION} appliquées")
+    return SCHEMA_VERSION
 
 
 import re
@@ -73,9 +892,9 @@ DEFAULT_CONFIG = {
     "daily_cooldown": 86400,
 
     # Vol
-    "vols_max_par_jours": 3,
-    "minimum_volable": 10,
-    "maximum_volable": 120,
+    "vols_max_per_day": 3,
+    "vol_min_amount": 10,
+    "vol_max_amount": 120,
     "vol_cooldown": 3600,
 
     # Echange
@@ -84,87 +903,1253 @@ DEFAULT_CONFIG = {
     "echange_cooldown": 0,  # pas de cooldown
 }
 
+# Anciens noms de clés encore présents dans certaines bases : migrés au chargement
+CONFIG_ALIASES = {
+    "vols_max_par_jours": "vols_max_per_day",
+    "minimum_volable": "vol_min_amount",
+    "maximum_volable": "vol_max_amount",
+}
+
 CATEGORIES = {
     "Daily": ["daily_amount", "daily_cooldown"],
-    "Vol": ["vols_max_par_jours", "minimum_volable", "maximum_volable", "vol_cooldown"],
+    "Vol": ["vols_max_per_day", "vol_min_amount", "vol_max_amount", "vol_cooldown"],
     "Échange": ["echanges_max_per_day", "echange_max_amount", "echange_cooldown"],
 }
 
-async def get_config(key):
-    async with aiosqlite.connect("eco.db") as db:
-        cursor = await db.execute("SELECT value FROM config WHERE key = ?", (key,))
-        res = await cursor.fetchone()
-        if not res:
-            await db.execute("INSERT INTO config VALUES (?, ?)", (key, str(DEFAULT_CONFIG[key])))
-            await db.commit()
-            return DEFAULT_CONFIG[key]
-        return type(DEFAULT_CONFIG[key])(res[0])
+# Valeurs typées par serveur, chargées au premier usage du serveur puis tenues à jour par set_config
+_config_cache = defaultdict(dict)
+
+@timed
+async def load_config(guild_id):
+    unknown = [p for params in CATEGORIES.values() for p in params if p not in DEFAULT_CONFIG]
+    if unknown:
+        raise ValueError(f"Paramètres sans valeur par défaut dans CATEGORIES : {', '.join(unknown)}")
+    rows = await guild_db(guild_id).fetchall("SELECT key, value FROM config WHERE guild_id = ?", (guild_id,))
+    stored = dict(rows)
+    values = {}
+    for key, default in DEFAULT_CONFIG.items():
+        raw = stored.get(key)
+        if raw is None:
+            # Reprend la valeur d'un ancien nom de clé si elle existe
+            raw = next((stored[old] for old, new in CONFIG_ALIASES.items() if new == key and old in stored), None)
+        try:
+            values[key] = default if raw is None else type(default)(raw)
+        except ValueError:
+            print(f"Config : valeur invalide pour {key} ({raw!r}), valeur par défaut utilisée")
+            values[key] = default
+    for key in stored:
+        if key not in DEFAULT_CONFIG and key not in CONFIG_ALIASES:
+            print(f"Config : clé inconnue ignorée ({key})")
+    async with guild_db(guild_id).write() as conn:
+        await conn.executemany("INSERT OR IGNORE INTO config (guild_id, key, value) VALUES (?, ?, ?)",
+                               [(guild_id, key, str(value)) for key, value in values.items()])
+        await conn.executemany("DELETE FROM config WHERE guild_id = ? AND key = ?",
+                               [(guild_id, old) for old in CONFIG_ALIASES])
+    _config_cache[guild_id] = values
 
-async def set_config(key, value):
-    async with aiosqlite.connect("eco.db") as db:
-        await db.execute("REPLACE INTO config (key, value) VALUES (?, ?)", (key, str(value)))
-        await db.commit()
+def get_config(guild_id, key):
+    return _config_cache[guild_id].get(key, DEFAULT_CONFIG[key])
+
+def get_configs(guild_id, keys):
+    return {key: get_config(guild_id, key) for key in keys}
+
+@timed
+async def set_config(guild_id, key, value):
+    value = type(DEFAULT_CONFIG[key])(value)
+    async with guild_db(guild_id).write() as conn:
+        await conn.execute("REPLACE INTO config (guild_id, key, value) VALUES (?, ?, ?)", (guild_id, key, str(value)))
+    _config_cache[guild_id][key] = value
 
 # --------- ECONOMY HELPERS ----------
-async def get_balance(user_id):
-    async with aiosqlite.connect("eco.db") as db:
-        cursor = await db.execute("SELECT balance FROM users WHERE id = ?", (user_id,))
+STARTING_BALANCE = 100
+
+# Mode write-behind : les soldes vivent en mémoire et sont écrits par lots.
+# ECO_FLUSH_INTERVAL_MS borne la durée pendant laquelle un changement n'existe qu'en mémoire.
+WRITE_BEHIND = os.getenv("ECO_WRITE_BEHIND", "0") == "1"
+FLUSH_INTERVAL_MS = int(os.getenv("ECO_FLUSH_INTERVAL_MS", "500"))
+FLUSH_MAX_DIRTY = int(os.getenv("ECO_FLUSH_MAX_DIRTY", "500"))
+
+
+class BalanceCache(BackgroundWriter):
+    """
+    Soldes en mémoire (le bot est le seul écrivain de users).
+    Les lignes modifiées sont écrites avec un seul executemany toutes les
+    interval_ms millisecondes, ou dès que max_dirty lignes attendent.
+    """
+
+    name = "Write-behind"
+
+    def __init__(self, interval_ms=FLUSH_INTERVAL_MS, max_dirty=FLUSH_MAX_DIRTY):
+        super().__init__()
+        self.interval = interval_ms / 1000
+        self.max_dirty = max_dirty
+        self.balances = defaultdict(dict)
+        self.dirty = set()
+        self.stats = {"flushes": 0, "rows_flushed": 0, "last_batch": 0, "max_batch": 0}
+
+    async def load(self, guild_id):
+        rows = await guild_db(guild_id).fetchall("SELECT id, balance FROM users WHERE guild_id = ?", (guild_id,))
+        self.balances[guild_id] = {uid: int(balance) for uid, balance in rows}
+        self.loaded = True
+
+    def _mark(self, guild_id, user_id):
+        self.dirty.add((guild_id, user_id))
+        if len(self.dirty) >= self.max_dirty:
+            self._wakeup.set()
+
+    def get(self, guild_id, user_id):
+        balances = self.balances[guild_id]
+        if user_id not in balances:
+            balances[user_id] = STARTING_BALANCE
+            self._mark(guild_id, user_id)
+            ledger.record(guild_id, None, None, user_id, STARTING_BALANCE, "creation")
+        return balances[user_id]
+
+    def apply(self, guild_id, user_id, change):
+        old = self.get(guild_id, user_id)
+        new_balance = max(old + change, 0)
+        self.balances[guild_id][user_id] = new_balance
+        self._mark(guild_id, user_id)
+        return new_balance, new_balance - old
+
+    def transfer(self, guild_id, from_id, to_id, amount, require_funds=True):
+        # Aucun await ici : la lecture et les deux écritures sont atomiques pour la boucle asyncio
+        if require_funds and self.get(guild_id, from_id) < amount:
+            return None
+        from_balance, debited = self.apply(guild_id, from_id, -amount)
+        to_balance, _ = self.apply(guild_id, to_id, amount)
+        return (to_balance if from_id == to_id else from_balance), to_balance, -debited
+
+    async def _flush(self):
+        if not self.dirty:
+            return 0
+        batch = [(gid, uid, self.balances[gid][uid]) for gid, uid in self.dirty]
+        self.dirty.clear()
+        await self.write_grouped(batch, self._write, lambda rows: self.dirty.update((gid, uid) for gid, uid, _ in rows))
+        self.stats["flushes"] += 1
+        self.stats["rows_flushed"] += len(batch)
+        self.stats["last_batch"] = len(batch)
+        self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+        return len(batch)
+
+    @staticmethod
+    async def _write(conn, rows):
+        await conn.executemany(
+            "INSERT INTO users (guild_id, id, balance) VALUES (?, ?, ?) "
+            "ON CONFLICT(guild_id, id) DO UPDATE SET balance = excluded.balance", rows)
+
+    async def stop(self):
+        await super().stop()
+        if self.loaded:
+            print(f"Write-behind : {self.stats['flushes']} écritures, {self.stats['rows_flushed']} lignes "
+                  f"(lot max {self.stats['max_batch']})")
+
+
+balance_cache = BalanceCache()
+
+# --------- CLASSEMENT ----------
+LEADERBOARD_SIZE = 10
+LEADERBOARD_THUMBNAIL = "https://media.discordapp.net/attachments/1065772841426444360/1149979817055051847/leaderboard.gif"
+
+
+class Leaderboard:
+    """
+    Index trié (-solde, id) de tous les joueurs, tenu à jour à chaque changement de solde.
+    Le rang d'un joueur est une recherche dichotomique : O(log n), sans COUNT(*) en base.
+    """
+
+    def __init__(self, guild_id, size=LEADERBOARD_SIZE):
+        self.guild_id = guild_id
+        self.size = size
+        self.keys = []
+        self.balances = {}
+        self.version = 0
+        self.loaded = False
+        self._embed = None
+        self._embed_version = -1
+
+    async def load(self):
+        rows = await guild_db(self.guild_id).fetchall(
+            "SELECT id, balance FROM users WHERE guild_id = ? ORDER BY balance DESC, id", (self.guild_id,))
+        if len(rows) >= OFFLOAD_MIN_ROWS:
+            self.balances, self.keys = await offload(_index_rows, rows)
+        else:
+            self.balances, self.keys = _index_rows(rows)
+        self.version += 1
+        self.loaded = True
+
+    def update(self, user_id, balance):
+        old = self.balances.get(user_id)
+        if old == balance or not self.loaded:
+            return
+        touches_top = False
+        if old is not None:
+            pos = bisect.bisect_left(self.keys, (-old, user_id))
+            del self.keys[pos]
+            touches_top = pos < self.size
+        key = (-balance, user_id)
+        pos = bisect.bisect_left(self.keys, key)
+        self.keys.insert(pos, key)
+        self.balances[user_id] = balance
+        if touches_top or pos < self.size:
+            self.version += 1
+
+    def rank(self, user_id):
+        balance = self.balances.get(user_id)
+        if balance is None:
+            return None
+        return bisect.bisect_left(self.keys, (-balance, user_id)) + 1
+
+    def at_least(self, balance):
+        pos = bisect.bisect_right(self.keys, (-balance, math.inf))
+        return [uid for _, uid in self.keys[:pos]]
+
+    def top(self):
+        return [(uid, -neg) for neg, uid in self.keys[:self.size]]
+
+    def page_after(self, cursor=None):
+        """
+        Pagination par curseur : la page qui suit la clé (-solde, id) cursor, ou la première.
+        Recherche dichotomique puis tranche : O(log n + taille de page), quelle que soit la profondeur.
+        Renvoie (index de la première ligne, [(-solde, id)]).
+        """
+        start = 0 if cursor is None else bisect.bisect_right(self.keys, cursor)
+        return start, self.keys[start:start + self.size]
+
+    def page_before(self, cursor):
+        end = bisect.bisect_left(self.keys, cursor)
+        start = max(end - self.size, 0)
+        return start, self.keys[start:start + self.size]
+
+    def _page_body(self, start, rows):
+        desc = "".join(f"{idx}. <@{uid}> — {-neg}€\n" for idx, (neg, uid) in enumerate(rows, start + 1))
+        header = (f"**Top {self.size} des joueurs les plus fortunés :**" if start == 0
+                  else f"**Places {start + 1} à {start + len(rows)} :**")
+        embed = discord.Embed(title="🏆 CLASSEMENT DES RICHES", description=f"{header}\n\n{desc}", color=0x2ECC71)
+        embed.set_thumbnail(url=LEADERBOARD_THUMBNAIL)
+        return embed
+
+    def _footer(self, embed, start):
+        pages = max(math.ceil(len(self.keys) / self.size), 1)
+        return embed.set_footer(text=f"Page {start // self.size + 1}/{pages} • "
+                                     f"Actualisé le {datetime.now().strftime('%d/%m/%Y %H:%M')}", icon_url=None)
+
+    def page_embed(self, start, rows):
+        return self._footer(self._page_body(start, rows), start)
+
+    def embed(self):
+        # Le corps n'est reconstruit que si le top a réellement changé depuis le dernier rendu ;
+        # le pied de page (nombre de pages, heure) dépend de tout l'index et se pose sur chaque copie
+        if self._embed_version != self.version:
+            self._embed = self._page_body(0, self.keys[:self.size])
+            self._embed_version = self.version
+        return self._footer(self._embed.copy(), 0)
+
+
+def _index_rows(rows):
+    # Déjà triées par la requête (balance DESC, id) : inutile de retrier en Python
+    return {uid: int(balance) for uid, balance in rows}, [(-int(balance), uid) for uid, balance in rows]
+
+# Un classement par serveur
+leaderboards = {}
+
+def get_leaderboard(guild_id):
+    board = leaderboards.get(guild_id)
+    if board is None:
+        board = leaderboards[guild_id] = Leaderboard(guild_id)
+    return board
+
+# --------- JOURNAL DES TRANSACTIONS ----------
+LEDGER_FLUSH_INTERVAL_MS = int(os.getenv("ECO_LEDGER_FLUSH_INTERVAL_MS", "1000"))
+LEDGER_BATCH = 500
+
+
+class Ledger(BackgroundWriter):
+    """
+    Journal append-only de chaque mouvement de solde. Les commandes ne font qu'ajouter
+    à une file en mémoire ; la tâche de fond l'écrit par lots d'executemany.
+    from_id None : argent créé (daily, création de compte) ; to_id None : argent retiré.
+    """
+
+    name = "Journal"
+
+    def __init__(self, interval_ms=LEDGER_FLUSH_INTERVAL_MS, batch_size=LEDGER_BATCH):
+        super().__init__()
+        self.interval = interval_ms / 1000
+        self.batch_size = batch_size
+        self.queue = deque()
+        self.loaded = True
+
+    def record(self, guild_id, actor, from_id, to_id, amount, action):
+        self.queue.append((guild_id, time.time(), actor, from_id, to_id, amount, action))
+        if len(self.queue) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _flush(self):
+        # Seulement les entrées présentes au début du vidage : sous un trafic continu,
+        # celles qui arrivent pendant l'écriture attendent le prochain tick au lieu de prolonger ce flush
+        remaining = len(self.queue)
+        written = 0
+        while remaining:
+            batch = [self.queue.popleft() for _ in range(min(self.batch_size, remaining))]
+            remaining -= len(batch)
+            await self.write_grouped(batch, self._write, lambda rows: self.queue.extendleft(reversed(rows)))
+            written += len(batch)
+        return written
+
+    @staticmethod
+    async def _write(conn, rows):
+        await conn.executemany(
+            "INSERT INTO ledger (guild_id, ts, actor, from_id, to_id, amount, action) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+ledger = Ledger()
+
+@timed
+async def replay_ledger(guild_id, fix=False):
+    """
+    Recalcule chaque solde du serveur à partir du journal et le compare à users.balance.
+    Renvoie la liste des écarts (user_id, solde_journal, solde_actuel) ;
+    avec fix=True, users.balance est réécrit avec la valeur du journal.
+    """
+    expected, actual = await _replay_balances(guild_id)
+    if len(actual) >= OFFLOAD_MIN_ROWS:
+        mismatches = await offload(_balance_mismatches, expected, actual)
+    else:
+        mismatches = _balance_mismatches(expected, actual)
+    if not mismatches:
+        return mismatches
+    # Une commande validée entre le vidage du journal et la lecture de users a son écriture encore en file :
+    # on revérifie chaque joueur divergent sous son verrou, où plus aucune mutation ne peut passer
+    suspects = [uid for uid, _, _ in mismatches]
+    async with user_locks.hold(guild_id, *suspects):
+        expected, actual = await _replay_balances(guild_id)
+        mismatches = [(uid, expected.get(uid, 0), actual.get(uid, 0))
+                      for uid in suspects if expected.get(uid, 0) != actual.get(uid, 0)]
+        if fix and mismatches:
+            async with guild_db(guild_id).write() as conn:
+                await conn.executemany(
+                    "INSERT INTO users (guild_id, id, balance) VALUES (?, ?, ?) "
+                    "ON CONFLICT(guild_id, id) DO UPDATE SET balance = excluded.balance",
+                    [(guild_id, uid, balance) for uid, balance, _ in mismatches])
+            _forget_lookups(guild_id, *(uid for uid, _, _ in mismatches))
+            for uid, balance, _ in mismatches:
+                if WRITE_BEHIND and balance_cache.loaded:
+                    balance_cache.balances[guild_id][uid] = balance
+                get_leaderboard(guild_id).update(uid, balance)
+    return mismatches
+
+async def _replay_balances(guild_id):
+    """(soldes rejoués depuis le journal, soldes de users) du serveur, caches vidés d'abord."""
+    await ledger.flush()
+    if WRITE_BEHIND:
+        await balance_cache.flush()
+    database = guild_db(guild_id)
+    expected = dict(await database.fetchall(
+        "SELECT id, SUM(delta) FROM ("
+        " SELECT to_id AS id, amount AS delta FROM ledger WHERE guild_id = ? AND to_id IS NOT NULL"
+        " UNION ALL SELECT from_id, -amount FROM ledger WHERE guild_id = ? AND from_id IS NOT NULL"
+        ") GROUP BY id", (guild_id, guild_id)))
+    actual = dict(await database.fetchall("SELECT id, balance FROM users WHERE guild_id = ?", (guild_id,)))
+    return expected, actual
+
+def _balance_mismatches(expected, actual):
+    return [(uid, expected.get(uid, 0), actual.get(uid, 0))
+            for uid in sorted(expected.keys() | actual.keys())
+            if expected.get(uid, 0) != actual.get(uid, 0)]
+
+async def _ensure_users(conn, guild_id, *user_ids):
+    for uid in set(user_ids):
+        async with conn.execute("INSERT OR IGNORE INTO users (guild_id, id, balance) VALUES (?, ?, ?)",
+                                (guild_id, uid, STARTING_BALANCE)) as cursor:
+            if cursor.rowcount:
+                ledger.record(guild_id, None, None, uid, STARTING_BALANCE, "creation")
+
+async def _apply_change(conn, guild_id, user_id, change):
+    """Renvoie (nouveau_solde, variation_réelle) : un débit peut être rogné par le plancher à 0."""
+    if change < 0:
+        async with conn.execute("SELECT balance FROM users WHERE guild_id = ? AND id = ?",
+                                (guild_id, user_id)) as cursor:
+            old = int((await cursor.fetchone())[0])
+    async with conn.execute("UPDATE users SET balance = MAX(balance + ?, 0) WHERE guild_id = ? AND id = ? "
+                            "RETURNING balance", (change, guild_id, user_id)) as cursor:
         res = await cursor.fetchone()
-        if not res:
-            await db.execute("INSERT INTO users VALUES (?, ?)", (user_id, 100))
-            await db.commit()
-            return 100
+    new_balance = int(res[0])
+    return new_balance, (new_balance - old if change < 0 else change)
+
+class _UserLock:
+    __slots__ = ("lock", "owner", "refs")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.owner = None
+        self.refs = 0
+
+
+class UserLocks:
+    """
+    Un verrou par joueur : les mutations d'un même solde passent une par une, dans l'ordre
+    d'arrivée, et les joueurs indépendants avancent en parallèle. Plusieurs joueurs sont pris
+    par identifiant croissant (deux transferts croisés ne s'interbloquent pas) ; la tâche qui
+    tient déjà un joueur peut le reprendre (lecture puis écriture dans /remove et /reset).
+    Un verrou libre sans attente est retiré du dictionnaire.
+    """
+
+    def __init__(self):
+        self.locks = {}
+
+    @asynccontextmanager
+    async def hold(self, guild_id, *user_ids):
+        task = asyncio.current_task()
+        taken = []
+        try:
+            for uid in sorted(set(user_ids)):
+                key = (guild_id, uid)
+                entry = self.locks.get(key)
+                if entry is None:
+                    entry = self.locks[key] = _UserLock()
+                elif entry.owner is task:
+                    continue
+                entry.refs += 1
+                taken.append((key, entry))
+                if entry.lock.locked():
+                    metrics.inc("eco_user_lock_waits_total", current_command.get())
+                await entry.lock.acquire()
+                entry.owner = task
+            yield
+        finally:
+            for key, entry in reversed(taken):
+                if entry.owner is task:
+                    entry.owner = None
+                    entry.lock.release()
+                entry.refs -= 1
+                if not entry.refs:
+                    del self.locks[key]
+
+
+user_locks = UserLocks()
+
+# Lectures de solde en cours, partagées par les appels simultanés sur le même joueur
+_balance_lookups = {}
+
+def _forget_lookups(guild_id, *user_ids):
+    # Après une mutation, une lecture partie avant l'écriture ne doit plus être partagée
+    for uid in user_ids:
+        _balance_lookups.pop((guild_id, uid), None)
+
+async def _read_balance(guild_id, user_id):
+    database = guild_db(guild_id)
+    res = await database.fetchone("SELECT balance FROM users WHERE guild_id = ? AND id = ?", (guild_id, user_id))
+    if res:
         return int(res[0])
+    async with database.write() as conn:
+        await _ensure_users(conn, guild_id, user_id)
+    return STARTING_BALANCE
 
-async def update_balance(user_id, change):
-    balance = await get_balance(user_id)
-    new_balance = max(balance + change, 0)
-    async with aiosqlite.connect("eco.db") as db:
-        await db.execute("UPDATE users SET balance = ? WHERE id = ?", (new_balance, user_id))
-        await db.commit()
+@timed
+async def get_balance(guild_id, user_id):
+    if WRITE_BEHIND:
+        balance = balance_cache.get(guild_id, user_id)
+    else:
+        key = (guild_id, user_id)
+        lookup = _balance_lookups.get(key)
+        if lookup is None:
+            lookup = _balance_lookups[key] = asyncio.ensure_future(_read_balance(guild_id, user_id))
+            lookup.add_done_callback(lambda done: _balance_lookups.pop(key) if _balance_lookups.get(key) is done else None)
+        else:
+            metrics.inc("eco_balance_coalesced_total", current_command.get())
+        # shield : l'annulation d'un appelant n'interrompt pas la lecture des autres
+        balance = await asyncio.shield(lookup)
+    board = get_leaderboard(guild_id)
+    # Une lecture peut finir après une mutation plus récente : seules les mutations mettent l'index à jour,
+    # la lecture n'y ajoute qu'un joueur encore absent (compte créé par cette lecture)
+    if user_id not in board.balances:
+        board.update(user_id, balance)
+    return balance
 
-# --------- QUOTA HELPERS ----------
-async def check_quota(user_id, action, max_allowed):
-    today = datetime.utcnow().strftime('%Y-%m-%d')
-    async with aiosqlite.connect("eco.db") as db:
-        row = await db.execute("SELECT count FROM quotas WHERE user_id=? AND action=? AND date=?", (user_id, action, today))
-        res = await row.fetchone()
-        return (res is None or int(res[0]) < max_allowed)
-
-async def increment_quota(user_id, action):
-    today = datetime.utcnow().strftime('%Y-%m-%d')
-    async with aiosqlite.connect("eco.db") as db:
-        old = await db.execute("SELECT count FROM quotas WHERE user_id=? AND action=? AND date=?", (user_id, action, today))
-        res = await old.fetchone()
-        if res is None:
-            await db.execute("INSERT INTO quotas VALUES (?, ?, ?, ?)", (user_id, action, 1, today))
+@timed
+async def update_balance(guild_id, user_id, change, action="ajustement", actor=None):
+    async with user_locks.hold(guild_id, user_id):
+        if WRITE_BEHIND:
+            balance, applied = balance_cache.apply(guild_id, user_id, change)
         else:
-            await db.execute("UPDATE quotas SET count = ? WHERE user_id=? AND action=? AND date=?",
-                             (int(res[0])+1, user_id, action, today))
-        await db.commit()
+            async with guild_db(guild_id).write() as conn:
+                await _ensure_users(conn, guild_id, user_id)
+                balance, applied = await _apply_change(conn, guild_id, user_id, change)
+            _forget_lookups(guild_id, user_id)
+        # Journal et classement sous le verrou du joueur : replay_ledger ne voit jamais un solde sans son écriture
+        if applied > 0:
+            ledger.record(guild_id, actor, None, user_id, applied, action)
+        elif applied < 0:
+            ledger.record(guild_id, actor, user_id, None, -applied, action)
+        get_leaderboard(guild_id).update(user_id, balance)
+    return balance
+
+@timed
+async def transfer(guild_id, from_id, to_id, amount, quota=None, require_funds=True, action="transfert", actor=None):
+    """
+    Débite from_id et crédite to_id dans une seule transaction, quota compris.
+    quota : (user_id, action, max_allowed) consommé avant l'écriture et rendu si le transfert échoue ;
+    lève QuotaExceeded (et rien n'est écrit) si la limite du jour est atteinte.
+    Renvoie (solde_emetteur, solde_recepteur), ou None si require_funds et fonds insuffisants.
+    """
+    if amount <= 0:
+        # Un montant négatif inverserait le sens du transfert sans que le journal suive le plancher à 0
+        raise ValueError(f"montant de transfert non positif : {amount}")
+    if quota and not consume_quota(guild_id, *quota):
+        raise QuotaExceeded(quota[1])
+    try:
+        async with user_locks.hold(guild_id, from_id, to_id):
+            if WRITE_BEHIND:
+                result = balance_cache.transfer(guild_id, from_id, to_id, amount, require_funds)
+            else:
+                result = await _transfer_db(guild_id, from_id, to_id, amount, require_funds)
+                _forget_lookups(guild_id, from_id, to_id)
+            if result is not None:
+                # Sous les verrous, comme dans update_balance
+                from_balance, to_balance, debited = result
+                ledger.record(guild_id, actor, from_id, to_id, debited, action)
+                if debited < amount:
+                    # Sans require_funds, la part non couverte par l'émetteur est créée
+                    ledger.record(guild_id, actor, None, to_id, amount - debited, action)
+                board = get_leaderboard(guild_id)
+                board.update(from_id, from_balance)
+                board.update(to_id, to_balance)
+    except BaseException:
+        if quota:
+            release_quota(guild_id, *quota[:2])
+        raise
+    if result is None:
+        if quota:
+            release_quota(guild_id, *quota[:2])
+        return None
+    return result[:2]
+
+async def _transfer_db(guild_id, from_id, to_id, amount, require_funds):
+    async with guild_db(guild_id).write() as conn:
+        await _ensure_users(conn, guild_id, from_id, to_id)
+        if require_funds:
+            async with conn.execute("UPDATE users SET balance = balance - ? WHERE guild_id = ? AND id = ? AND balance >= ? "
+                                    "RETURNING balance", (amount, guild_id, from_id, amount)) as cursor:
+                res = await cursor.fetchone()
+            if res is None:
+                return None
+            from_balance, debited = int(res[0]), amount
+        else:
+            from_balance, applied = await _apply_change(conn, guild_id, from_id, -amount)
+            debited = -applied
+        to_balance, _ = await _apply_change(conn, guild_id, to_id, amount)
+    if from_id == to_id:
+        from_balance = to_balance
+    return from_balance, to_balance, debited
+
+# --------- OPÉRATIONS GROUPÉES ----------
+BULK_OPERATIONS = {"giveaway": "🎁 Giveaway", "remove": "💸 Retrait", "reset": "🔄 Remise à zéro"}
+BULK_SELECT_CHUNK = 500
+# En write-behind, la boucle sur les cibles rend la main tous les BULK_YIELD_EVERY joueurs : /solde n'attend pas un /masse
+BULK_YIELD_EVERY = 500
+
+def _bulk_new_balance(op, balance, amount):
+    if op == "giveaway":
+        return balance + amount
+    if op == "remove":
+        return max(balance - amount, 0)
+    return 0
+
+def bulk_preview(guild_id, user_ids, op, amount):
+    """Soldes (user_id, avant, après) calculés sur les données en mémoire, sans rien écrire."""
+    known = balance_cache.balances[guild_id] if WRITE_BEHIND else get_leaderboard(guild_id).balances
+    rows = []
+    for uid in user_ids:
+        old = known.get(uid, STARTING_BALANCE)
+        rows.append((uid, old, _bulk_new_balance(op, old, amount)))
+    return rows
+
+@timed
+async def bulk_apply(guild_id, user_ids, op, amount, actor=None):
+    """
+    Applique l'opération à toutes les cibles en une seule transaction :
+    une lecture par tranche de 500 identifiants, puis un seul executemany.
+    Renvoie [(user_id, solde_avant, solde_après)].
+    """
+    async with user_locks.hold(guild_id, *user_ids):
+        return await _bulk_apply(guild_id, user_ids, op, amount, actor)
+
+async def _bulk_apply(guild_id, user_ids, op, amount, actor):
+    action = f"{op}_masse"
+    board = get_leaderboard(guild_id)
+    if WRITE_BEHIND:
+        rows = []
+        for i, uid in enumerate(user_ids, 1):
+            # Chaque cible est traitée sans await : solde, journal et classement restent cohérents entre deux pauses
+            old = balance_cache.get(guild_id, uid)
+            new, _ = balance_cache.apply(guild_id, uid, _bulk_new_balance(op, old, amount) - old)
+            _record_bulk(guild_id, board, uid, old, new, action, actor)
+            rows.append((uid, old, new))
+            if i % BULK_YIELD_EVERY == 0:
+                await asyncio.sleep(0)
+        return rows
+    async with guild_db(guild_id).write() as conn:
+        current = {}
+        for i in range(0, len(user_ids), BULK_SELECT_CHUNK):
+            chunk = user_ids[i:i + BULK_SELECT_CHUNK]
+            async with conn.execute(f"SELECT id, balance FROM users WHERE guild_id = ? "
+                                    f"AND id IN ({','.join('?' * len(chunk))})", (guild_id, *chunk)) as cursor:
+                current.update((uid, int(balance)) for uid, balance in await cursor.fetchall())
+        for uid in user_ids:
+            if uid not in current:
+                current[uid] = STARTING_BALANCE
+                ledger.record(guild_id, None, None, uid, STARTING_BALANCE, "creation")
+        rows = [(uid, current[uid], _bulk_new_balance(op, current[uid], amount)) for uid in user_ids]
+        await conn.executemany(
+            "INSERT INTO users (guild_id, id, balance) VALUES (?, ?, ?) "
+            "ON CONFLICT(guild_id, id) DO UPDATE SET balance = excluded.balance",
+            [(guild_id, uid, new) for uid, _, new in rows])
+    _forget_lookups(guild_id, *user_ids)
+    for uid, old, new in rows:
+        _record_bulk(guild_id, board, uid, old, new, action, actor)
+    return rows
+
+def _record_bulk(guild_id, board, uid, old, new, action, actor):
+    if new > old:
+        ledger.record(guild_id, actor, None, uid, new - old, action)
+    elif new < old:
+        ledger.record(guild_id, actor, uid, None, old - new, action)
+    board.update(uid, new)
+
+def resolve_targets(guild_id, role=None, membres=None, seuil=None):
+    ids = set()
+    if role is not None:
+        ids.update(member.id for member in role.members if not member.bot)
+    if membres:
+        ids.update(int(uid) for uid in re.findall(r"\d{15,20}", membres))
+    if seuil is not None:
+        ids.update(get_leaderboard(guild_id).at_least(seuil))
+    return sorted(ids)
+
+# --------- QUOTA HELPERS ----------
+# Les compteurs du jour vivent en mémoire ; la table quotas ne garde que l'historique récent
+QUOTA_FLUSH_INTERVAL = int(os.getenv("ECO_QUOTA_FLUSH_INTERVAL", "5"))
+QUOTA_RETENTION_DAYS = int(os.getenv("ECO_QUOTA_RETENTION_DAYS", "7"))
+QUOTA_PRUNE_INTERVAL = int(os.getenv("ECO_QUOTA_PRUNE_INTERVAL", "21600"))
+QUOTA_PRUNE_BATCH = 500
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def _today():
+    return datetime.utcnow().strftime('%Y-%m-%d')
+
+
+class QuotaCounter(BackgroundWriter):
+    """
+    Compteurs du jour par (guild_id, user_id, action). La vérification et l'incrément se font
+    sans await, donc de façon atomique ; les lignes modifiées sont écrites périodiquement.
+    """
+
+    name = "Quotas"
+
+    def __init__(self, flush_interval=QUOTA_FLUSH_INTERVAL):
+        super().__init__()
+        self.interval = flush_interval
+        self.date = _today()
+        self.counts = {}
+        self.dirty = set()
+        self._pending = []
+        self._last_prune = None
+
+    async def load(self, guild_id):
+        self._roll()
+        rows = await guild_db(guild_id).fetchall(
+            "SELECT user_id, action, count FROM quotas WHERE guild_id = ? AND date = ?", (guild_id, self.date))
+        self.counts.update(((guild_id, uid, action), int(count)) for uid, action, count in rows)
+        self.loaded = True
+
+    def _roll(self):
+        today = _today()
+        if today != self.date:
+            # Les compteurs d'hier partent à l'écriture avec leur date, puis on repart de zéro
+            self._pending.extend((*key, self.counts[key], self.date) for key in self.dirty)
+            self.counts = {}
+            self.dirty = set()
+            self.date = today
+
+    def consume(self, guild_id, user_id, action, max_allowed=None):
+        self._roll()
+        key = (guild_id, user_id, action)
+        count = self.counts.get(key, 0)
+        if max_allowed is not None and count >= max_allowed:
+            return False
+        self.counts[key] = count + 1
+        self.dirty.add(key)
+        return True
+
+    def release(self, guild_id, user_id, action):
+        key = (guild_id, user_id, action)
+        if self.counts.get(key, 0) > 0:
+            self.counts[key] -= 1
+            self.dirty.add(key)
+
+    async def _flush(self):
+        self._roll()
+        batch = self._pending + [(*key, self.counts[key], self.date) for key in self.dirty]
+        if not batch:
+            return 0
+        self._pending = []
+        self.dirty = set()
+        await self.write_grouped(batch, self._write, self._requeue)
+        return len(batch)
+
+    @staticmethod
+    async def _write(conn, rows):
+        await conn.executemany(
+            "INSERT INTO quotas (guild_id, user_id, action, count, date) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(guild_id, user_id, action, date) DO UPDATE SET count = excluded.count", rows)
+
+    def _requeue(self, rows):
+        self._pending = [row for row in rows if row[4] != self.date] + self._pending
+        self.dirty.update(row[:3] for row in rows if row[4] == self.date)
+
+    async def prune(self, retention_days=QUOTA_RETENTION_DAYS, batch_size=QUOTA_PRUNE_BATCH):
+        """
+        Supprime les lignes plus vieilles que la rétention, par petits lots
+        pour ne jamais garder le verrou d'écriture longtemps.
+        """
+        cutoff = (datetime.utcnow() - timedelta(days=retention_days)).strftime('%Y-%m-%d')
+        pruned = 0
+        for database in databases():
+            while True:
+                async with database.write() as conn:
+                    async with conn.execute(
+                            "DELETE FROM quotas WHERE rowid IN (SELECT rowid FROM quotas WHERE date < ? LIMIT ?)",
+                            (cutoff, batch_size)) as cursor:
+                        deleted = cursor.rowcount
+                pruned += deleted
+                if deleted < batch_size:
+                    break
+                await asyncio.sleep(0.05)
+        if pruned:
+            print(f"Quotas : {pruned} lignes antérieures au {cutoff} supprimées")
+        return pruned
+
+    async def tick(self):
+        await self.flush()
+        now = asyncio.get_running_loop().time()
+        if self._last_prune is None or now - self._last_prune >= QUOTA_PRUNE_INTERVAL:
+            self._last_prune = now
+            await self.prune()
+
+
+quota_counter = QuotaCounter()
+
+def consume_quota(guild_id, user_id, action, max_allowed=None):
+    """
+    Consomme une utilisation du quota du jour si la limite n'est pas atteinte.
+    Renvoie True si l'action est autorisée (max_allowed None : pas de limite).
+    """
+    return quota_counter.consume(guild_id, user_id, action, max_allowed)
+
+def release_quota(guild_id, user_id, action):
+    quota_counter.release(guild_id, user_id, action)
+
+# --------- COOLDOWNS ----------
+COOLDOWN_FLUSH_INTERVAL = int(os.getenv("ECO_COOLDOWN_FLUSH_INTERVAL", "5"))
+
+
+class CooldownStore(BackgroundWriter):
+    """
+    Délais par (guild_id, user_id, action), persistés dans la table cooldowns.
+    La vérification est une simple lecture de dict ; un tas min retire
+    les entrées expirées de la mémoire, et les écritures partent par lots.
+    """
+
+    name = "Cooldowns"
+
+    def __init__(self, flush_interval=COOLDOWN_FLUSH_INTERVAL):
+        super().__init__()
+        self.interval = flush_interval
+        self.expires = {}
+        self.heap = []
+        self.dirty = set()
+
+    async def load(self, guild_id):
+        rows = await guild_db(guild_id).fetchall(
+            "SELECT user_id, action, expires_at FROM cooldowns WHERE guild_id = ? AND expires_at > ?",
+            (guild_id, time.time()))
+        for uid, action, expires_at in rows:
+            key = (guild_id, uid, action)
+            self.expires[key] = expires_at
+            heapq.heappush(self.heap, (expires_at, key))
+        self.loaded = True
+
+    def remaining(self, guild_id, user_id, action):
+        expires_at = self.expires.get((guild_id, user_id, action))
+        if expires_at is None:
+            return 0
+        return max(expires_at - time.time(), 0)
+
+    def acquire(self, guild_id, user_id, action, seconds):
+        """Démarre le délai s'il n'y en a pas en cours ; sinon renvoie le temps restant."""
+        remaining = self.remaining(guild_id, user_id, action)
+        if remaining or seconds <= 0:
+            return remaining
+        key = (guild_id, user_id, action)
+        expires_at = time.time() + seconds
+        self.expires[key] = expires_at
+        heapq.heappush(self.heap, (expires_at, key))
+        self.dirty.add(key)
+        return 0
+
+    def cancel(self, guild_id, user_id, action):
+        key = (guild_id, user_id, action)
+        if self.expires.pop(key, None) is not None:
+            self.dirty.add(key)
+
+    def _purge(self):
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now:
+            expires_at, key = heapq.heappop(self.heap)
+            if self.expires.get(key) == expires_at:
+                del self.expires[key]
+
+    async def _flush(self):
+        self._purge()
+        if not self.dirty:
+            return 0
+        keys, self.dirty = self.dirty, set()
+        await self.write_grouped(list(keys), self._write, self.dirty.update)
+        return len(keys)
+
+    async def _write(self, conn, keys):
+        upserts = [(*key, self.expires[key]) for key in keys if key in self.expires]
+        deletes = [key for key in keys if key not in self.expires]
+        await conn.executemany(
+            "INSERT INTO cooldowns (guild_id, user_id, action, expires_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(guild_id, user_id, action) DO UPDATE SET expires_at = excluded.expires_at", upserts)
+        await conn.executemany("DELETE FROM cooldowns WHERE guild_id = ? AND user_id = ? AND action = ?", deletes)
+        await conn.execute("DELETE FROM cooldowns WHERE expires_at <= ?", (time.time(),))
+
+
+cooldowns = CooldownStore()
+
+async def check_cooldown(interaction, action, claim=False):
+    """
+    Délai de la commande, piloté par la config en direct (<action>_cooldown).
+    Renvoie True et prévient l'utilisateur si le délai est en cours.
+    Avec claim=True, démarre aussi le délai dans la même opération (sans await entre les deux).
+    """
+    guild_id = interaction.guild_id
+    if claim:
+        remaining = cooldowns.acquire(guild_id, interaction.user.id, action, get_config(guild_id, f"{action}_cooldown"))
+    else:
+        remaining = cooldowns.remaining(guild_id, interaction.user.id, action)
+    if remaining:
+        await respond(interaction, f"⏳ Attends {human_duration(remaining)} avant de rejouer.", ephemeral=True)
+        return True
+    return False
+
+# --------- SAUVEGARDES ----------
+BACKUP_DIR = os.getenv("ECO_BACKUP_DIR", "backups")
+BACKUP_INTERVAL = int(os.getenv("ECO_BACKUP_INTERVAL", "21600"))  # 0 : pas de sauvegarde automatique
+BACKUP_KEEP = int(os.getenv("ECO_BACKUP_KEEP", "7"))
+# Copie par petits pas avec une pause entre deux : le disque reste disponible pour les commandes
+BACKUP_PAGES = int(os.getenv("ECO_BACKUP_PAGES", "256"))
+BACKUP_STEP_SLEEP = int(os.getenv("ECO_BACKUP_STEP_SLEEP_MS", "10")) / 1000
+
+
+def _backup_file(path, dest_dir, pages=BACKUP_PAGES, step_sleep=BACKUP_STEP_SLEEP):
+    """
+    Copie en ligne de path avec l'API backup de SQLite, puis compression gzip. Bloquant : à lancer via offload.
+    Renvoie (archive, pages, nombre de pas, pas le plus long en secondes, taille compressée).
+    """
+    os.makedirs(dest_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    # Microsecondes : deux sauvegardes dans la même seconde (restauration juste après une sauvegarde)
+    # gardent des noms distincts, de même longueur, donc triés dans l'ordre chronologique
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S%f')
+    archive = os.path.join(dest_dir, f"{stem}-{stamp}.db.gz")
+    tmp = archive[:-3] + ".tmp"
+    steps = []
+    total_pages = 0
+    last = time.perf_counter()
+
+    def progress(status, remaining, total):
+        nonlocal last, total_pages
+        steps.append(time.perf_counter() - last)
+        total_pages = total
+        time.sleep(step_sleep)
+        last = time.perf_counter()
+
+    src = sqlite3.connect(path, isolation_level=None)
+    try:
+        # Transaction de lecture gardée pendant toute la copie : un instantané cohérent, sans que
+        # les écritures du bot entre deux pas ne fassent repartir la copie de zéro (WAL : elles continuent)
+        src.execute("BEGIN")
+        src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        dst = sqlite3.connect(tmp)
+        try:
+            src.backup(dst, pages=pages, progress=progress)
+        finally:
+            dst.close()
+        src.execute("COMMIT")
+    finally:
+        src.close()
+    with open(tmp, "rb") as raw, gzip.open(archive, "wb", compresslevel=6) as packed:
+        shutil.copyfileobj(raw, packed, 1 << 20)
+    os.remove(tmp)
+    return archive, total_pages, len(steps), max(steps, default=0.0), os.path.getsize(archive)
+
+def _rotate_backups(dest_dir, stem, keep=BACKUP_KEEP):
+    archives = [name for name in os.listdir(dest_dir) if name.startswith(f"{stem}-") and name.endswith(".db.gz")]
+    # Par date d'écriture, pas par nom : les anciens noms à suffixe .N se triaient avant l'archive sans suffixe
+    archives.sort(key=lambda name: (os.path.getmtime(os.path.join(dest_dir, name)), name))
+    for name in archives[:-keep] if keep > 0 else []:
+        os.remove(os.path.join(dest_dir, name))
+
+def _restore_file(archive, path):
+    """Remplace le contenu de path par l'archive, après contrôle d'intégrité. Le bot doit être arrêté."""
+    tmp = f"{path}.restauration"
+    with gzip.open(archive, "rb") as packed, open(tmp, "wb") as raw:
+        shutil.copyfileobj(packed, raw, 1 << 20)
+    try:
+        src = sqlite3.connect(tmp)
+        try:
+            status = src.execute("PRAGMA integrity_check").fetchone()[0]
+            if status != "ok":
+                raise ValueError(f"archive corrompue ({status})")
+            # Via l'API backup plutôt qu'une copie de fichier : les fichiers -wal/-shm restent cohérents
+            dst = sqlite3.connect(path)
+            try:
+                src.backup(dst)
+            finally:
+                dst.close()
+        finally:
+            src.close()
+    finally:
+        os.remove(tmp)
+
+
+def _database_paths():
+    # Tous les fichiers, y compris ceux des serveurs pas encore ouverts depuis le démarrage
+    paths = [DB_PATH]
+    if DB_PER_GUILD and os.path.isdir(GUILD_DB_DIR):
+        paths += sorted(os.path.join(GUILD_DB_DIR, name) for name in os.listdir(GUILD_DB_DIR) if name.endswith(".db"))
+    return paths
+
+
+class BackupScheduler:
+    """Sauvegarde périodique de chaque base (partagée et par serveur) dans BACKUP_DIR, avec rotation."""
+
+    def __init__(self, interval=BACKUP_INTERVAL):
+        self.interval = interval
+        self.last = None
+        self._task = None
+
+    async def run_once(self):
+        # Les caches en mémoire partent d'abord en base, pour que l'archive soit à jour
+        await ledger.flush()
+        if WRITE_BEHIND:
+            await balance_cache.flush()
+        archives = []
+        for path in _database_paths():
+            start = time.perf_counter()
+            archive, pages, steps, longest, size = await offload(_backup_file, path, BACKUP_DIR)
+            await offload(_rotate_backups, BACKUP_DIR, os.path.splitext(os.path.basename(path))[0])
+            elapsed = time.perf_counter() - start
+            metrics.observe(metrics.helpers, "sauvegarde", elapsed)
+            print(f"Sauvegarde {os.path.basename(archive)} : {pages} pages en {steps} pas de {BACKUP_PAGES} "
+                  f"(pas le plus long {longest * 1000:.1f} ms), {elapsed:.2f}s, {size // 1024} Ko")
+            archives.append(archive)
+        self.last = time.time()
+        return archives
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception as e:
+                print(f"Sauvegarde : échec ({e}), nouvel essai dans {human_duration(self.interval)}")
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+backups = BackupScheduler()
+
+# --------- EXPORT / IMPORT ----------
+# Export d'un serveur en NDJSON gzip : une ligne d'en-tête, puis pour chaque table une ligne
+# {"table", "columns"} suivie de lignes [[valeurs], ...] d'au plus EXPORT_CHUNK enregistrements.
+# Une ligne par tranche plutôt que par enregistrement : un seul appel à l'encodeur/décodeur JSON (en C)
+# pour 5000 lignes, et toujours une mémoire bornée à la lecture comme à l'écriture
+EXPORT_FORMAT = "eco-export"
+EXPORT_VERSION = 1
+EXPORT_CHUNK = int(os.getenv("ECO_EXPORT_CHUNK", "5000"))
+# L'identifiant du journal n'est pas exporté : il est renuméroté par la base qui importe
+EXPORT_COLUMNS = dict(GUILD_TABLES, ledger=GUILD_TABLES["ledger"][1:])
+_compact_json = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False).encode
+
+
+def _export_file(path, guild_id, dest, tables):
+    """
+    Écrit les lignes du serveur dans dest, table par table et par tranches de EXPORT_CHUNK :
+    la mémoire utilisée ne dépend pas de la taille des tables. Bloquant : à lancer via offload.
+    Renvoie {table: nombre de lignes}.
+    """
+    counts = {}
+    src = sqlite3.connect(path, isolation_level=None)
+    try:
+        # Une seule transaction de lecture : toutes les tables viennent du même instantané
+        src.execute("BEGIN")
+        with gzip.open(dest, "wt", encoding="utf-8", compresslevel=6) as out:
+            out.write(_compact_json({"format": EXPORT_FORMAT, "version": EXPORT_VERSION,
+                                     "guild_id": guild_id, "exported_at": time.time()}) + "\n")
+            for table in tables:
+                columns = EXPORT_COLUMNS[table]
+                out.write(_compact_json({"table": table, "columns": columns}) + "\n")
+                cursor = src.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE guild_id = ? ORDER BY rowid",
+                                     (guild_id,))
+                counts[table] = 0
+                while rows := cursor.fetchmany(EXPORT_CHUNK):
+                    out.write(_compact_json(rows) + "\n")
+                    counts[table] += len(rows)
+        src.execute("COMMIT")
+    finally:
+        src.close()
+    return counts
+
+def _read_export_header(archive):
+    with gzip.open(archive, "rt", encoding="utf-8") as src:
+        header = json.loads(src.readline() or "null")
+    if not isinstance(header, dict) or header.get("format") != EXPORT_FORMAT:
+        raise ValueError("ce fichier n'est pas un export de l'économie")
+    if header.get("version", 0) > EXPORT_VERSION:
+        raise ValueError(f"export en version {header['version']}, ce bot lit jusqu'à la version {EXPORT_VERSION}")
+    return header
+
+def _import_file(path, archive, guild_id):
+    """
+    Remplace les données du serveur guild_id par celles de l'archive, dans une seule transaction :
+    lecture en flux et un executemany par tranche. Bloquant, et le bot doit être arrêté.
+    Renvoie {table: nombre de lignes}.
+    """
+    counts = {}
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        # Gros import : plus de cache pour les index, le temps de cette connexion
+        conn.execute("PRAGMA cache_size=-65536")
+        conn.execute("BEGIN IMMEDIATE")
+        with gzip.open(archive, "rt", encoding="utf-8") as src:
+            src.readline()  # en-tête, déjà vérifié par _read_export_header
+            for table in GUILD_TABLES:
+                conn.execute(f"DELETE FROM {table} WHERE guild_id = ?", (guild_id,))
+            insert = None
+            for line in src:
+                record = json.loads(line)
+                if isinstance(record, dict):
+                    table, columns = record.get("table"), record.get("columns") or []
+                    # Noms vérifiés avant d'entrer dans la requête : seules les tables et colonnes connues passent
+                    if table not in GUILD_TABLES or not set(columns) <= set(GUILD_TABLES[table]):
+                        raise ValueError(f"table ou colonnes inconnues : {table} {columns}")
+                    insert = f"INSERT INTO {table} (guild_id, {', '.join(columns)}) VALUES (?{', ?' * len(columns)})"
+                    counts[table] = 0
+                    continue
+                if insert is None:
+                    raise ValueError("données avant toute table")
+                conn.executemany(insert, [(guild_id, *row) for row in record])
+                counts[table] += len(record)
+        if "ledger" not in counts:
+            # Export sans historique : les soldes importés deviennent des écritures d'ouverture
+            conn.execute("INSERT INTO ledger (ts, guild_id, actor, from_id, to_id, amount, action) "
+                         "SELECT ?, guild_id, NULL, NULL, id, balance, 'ouverture' FROM users "
+                         "WHERE guild_id = ? AND balance > 0", (time.time(), guild_id))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return counts
+
+async def export_guild(guild_id, dest, journal=True):
+    """Exporte le serveur dans dest (NDJSON gzip) après avoir vidé les caches ; renvoie {table: lignes}."""
+    await ledger.flush()
+    await quota_counter.flush()
+    await cooldowns.flush()
+    if WRITE_BEHIND:
+        await balance_cache.flush()
+    tables = [table for table in EXPORT_COLUMNS if journal or table != "ledger"]
+    return await offload(_export_file, guild_db(guild_id).path, guild_id, dest, tables)
 
 # --------- BOT READY ----------
-@bot.event
-async def on_ready():
+# Serveur qui reprend les données d'avant le multi-serveur ; par défaut, le seul serveur du bot
+LEGACY_GUILD_ID = int(os.getenv("ECO_LEGACY_GUILD", "0")) or None
+
+_open_guilds = set()
+_guild_locks = defaultdict(asyncio.Lock)
+_legacy_pending = False
+
+async def open_economy():
+    """Ouvre la base partagée, applique les migrations et démarre les écritures de fond ; sans effet si c'est déjà fait."""
+    global _legacy_pending
+    if db.is_open:
+        return
+    await db.open()
+    startup.mark("base")
     await init_db()
+    startup.mark("migrations")
+    _legacy_pending = await db.fetchone("SELECT 1 FROM users WHERE guild_id = ? LIMIT 1", (LEGACY_GUILD,)) is not None
+    for writer in (quota_counter, cooldowns, ledger) + ((balance_cache,) if WRITE_BEHIND else ()):
+        writer.loaded = True
+        writer.start()
+
+async def open_guild(guild_id):
+    """Prépare l'économie d'un serveur à son premier usage : base, config, soldes, quotas et délais."""
+    if guild_id in _open_guilds:
+        return
+    async with _guild_locks[guild_id]:
+        if guild_id in _open_guilds:
+            return
+        await open_economy()
+        await _adopt_legacy(guild_id)
+        if DB_PER_GUILD and guild_id != LEGACY_GUILD:
+            await _open_guild_db(guild_id)
+        await load_config(guild_id)
+        if WRITE_BEHIND:
+            await balance_cache.load(guild_id)
+        await get_leaderboard(guild_id).load()
+        await quota_counter.load(guild_id)
+        await cooldowns.load(guild_id)
+        _open_guilds.add(guild_id)
+
+async def _adopt_legacy(guild_id):
+    global _legacy_pending
+    if not _legacy_pending or guild_id == LEGACY_GUILD:
+        return
+    if LEGACY_GUILD_ID is None:
+        # Sans ECO_LEGACY_GUILD, on ne devine que si le bot connecté n'est que sur un serveur
+        if not bot.is_ready() or len(bot.guilds) != 1:
+            if bot.is_ready():
+                print("Données mono-serveur non rattachées : définir ECO_LEGACY_GUILD avec l'identifiant du serveur d'origine")
+            return
+    elif LEGACY_GUILD_ID != guild_id:
+        return
+    async with db.write() as conn:
+        for table in GUILD_TABLES:
+            await conn.execute(f"UPDATE OR IGNORE {table} SET guild_id = ? WHERE guild_id = ?", (guild_id, LEGACY_GUILD))
+    _legacy_pending = False
+    print(f"Données mono-serveur rattachées au serveur {guild_id}")
+
+async def _open_guild_db(guild_id):
+    os.makedirs(GUILD_DB_DIR, exist_ok=True)
+    path = os.path.join(GUILD_DB_DIR, f"{guild_id}.db")
+    created = not os.path.exists(path)
+    database = Database(path, readers=GUILD_DB_READERS)
+    await database.open()
+    await init_db(database)
+    if created:
+        # Passage à une base par serveur : les lignes du serveur quittent la base partagée
+        async with database.write() as conn:
+            for table, columns in GUILD_TABLES.items():
+                columns = ", ".join(("guild_id",) + columns)
+                rows = await db.fetchall(f"SELECT {columns} FROM {table} WHERE guild_id = ?", (guild_id,))
+                if rows:
+                    await conn.executemany(
+                        f"INSERT INTO {table} ({columns}) VALUES ({', '.join('?' * len(rows[0]))})", rows)
+        async with db.write() as conn:
+            for table in GUILD_TABLES:
+                await conn.execute(f"DELETE FROM {table} WHERE guild_id = ?", (guild_id,))
+    guild_dbs[guild_id] = database
+
+async def known_guilds():
+    """Serveurs ayant des données : base partagée, plus les fichiers de ECO_GUILD_DB_DIR."""
+    guilds = {gid for (gid,) in await db.fetchall("SELECT guild_id FROM users UNION SELECT guild_id FROM ledger")}
+    if DB_PER_GUILD and os.path.isdir(GUILD_DB_DIR):
+        guilds.update(int(name[:-3]) for name in os.listdir(GUILD_DB_DIR) if name.endswith(".db") and name[:-3].isdigit())
+    return sorted(guilds)
+
+async def close_economy():
+    # Vide les caches (soldes, quotas, cooldowns, journal) avant de fermer les connexions
+    await balance_cache.stop()
+    await quota_counter.stop()
+    await cooldowns.stop()
+    await ledger.stop()
+    for database in databases():
+        await database.close()
+    guild_dbs.clear()
+    _open_guilds.clear()
+
+async def sync_commands():
+    """
+    Envoie les commandes slash à Discord seulement si leur définition a changé :
+    l'empreinte de la dernière synchronisation est gardée dans la table meta.
+    """
+    payload = json.dumps([command.to_dict(tree) for command in tree.get_commands()], sort_keys=True)
+    digest = hashlib.sha256(f"{bot.application_id}:{payload}".encode()).hexdigest()
+    row = await db.fetchone("SELECT value FROM meta WHERE key = 'commands_hash'")
+    if row is not None and row[0] == digest:
+        return False
     await tree.sync()
-    print(f"Connecté en tant que {bot.user}")
+    async with db.write() as conn:
+        await conn.execute("REPLACE INTO meta (key, value) VALUES ('commands_hash', ?)", (digest,))
+    return True
+
+_first_ready = True
+
+@bot.event
+async def on_ready():
+    # Rappelé après chaque reconnexion sans reprise de session : rien de coûteux ici
+    global _first_ready
+    if _first_ready:
+        _first_ready = False
+        startup.mark("gateway")
+        print(f"Connecté en tant que {bot.user} ({len(bot.guilds)} serveurs, {bot.shard_count} shard(s))")
+        startup.report()
+    else:
+        startup.reconnected()
+
+@bot.event
+async def on_shard_disconnect(shard_id):
+    startup.disconnected()
+
+@bot.event
+async def on_shard_resumed(shard_id):
+    startup.reconnected()
 
 # --------- COMMANDES SLASH ----------
 
 @tree.command(name="solde", description="Voir ton solde")
+@app_commands.guild_only()
+@instrument
 async def solde(interaction: discord.Interaction, membre: discord.User = None):
     user = membre or interaction.user
-    balance = await get_balance(user.id)
+    balance = await get_balance(interaction.guild_id, user.id)
     embed = discord.Embed(title="💰 Solde", description=f"{user.mention} a **{balance}€**", color=0x3498db)
-    await interaction.response.send_message(embed=embed)
+    await respond(interaction, embed=embed)
 
 @tree.command(name="daily", description="Réclame ton bonus quotidien")
-@app_commands.checks.cooldown(1, DEFAULT_CONFIG["daily_cooldown"], key=lambda i: i.user.id)
+@app_commands.guild_only()
+@instrument
 async def daily(interaction: discord.Interaction):
-    montant_daily = await get_config("daily_amount")
-    await update_balance(interaction.user.id, montant_daily)
-    await increment_quota(interaction.user.id, "daily")
+    if await check_cooldown(interaction, "daily", claim=True):
+        return
+    guild_id = interaction.guild_id
+    montant_daily = get_config(guild_id, "daily_amount")
+    try:
+        await update_balance(guild_id, interaction.user.id, montant_daily, action="daily", actor=interaction.user.id)
+    except BaseException:
+        # Le délai a été pris avant l'écriture : sans bonus versé, le joueur doit pouvoir réessayer
+        cooldowns.cancel(guild_id, interaction.user.id, "daily")
+        raise
+    consume_quota(guild_id, interaction.user.id, "daily")
     thumb_url = "https://media.discordapp.net/attachments/1065772841426444360/1149979816433465414/daily.gif" # image bonus
     embed = discord.Embed(
         title="🎁 Bonus quotidien !",
@@ -173,99 +2158,223 @@ async def daily(interaction: discord.Interaction):
     )
     embed.set_thumbnail(url=thumb_url)
     embed.set_footer(text="Économie Discord", icon_url=interaction.user.avatar.url if interaction.user.avatar else None)
-    await interaction.response.send_message(embed=embed)
-
+    await respond(interaction, embed=embed)
 
-@daily.error
-async def daily_error(interaction, error):
-    if isinstance(error, app_commands.CommandOnCooldown):
-        mins = round(error.retry_after / 60)
-        await interaction.response.send_message(f"⏳ Attends {mins} minutes avant de rejouer.", ephemeral=True)
 
 @tree.command(name="voler", description="Voler de l'argent à quelqu'un")
+@app_commands.guild_only()
+@instrument
 async def voler(interaction: discord.Interaction, cible: discord.User):
     if cible.id == interaction.user.id:
-        await interaction.response.send_message("Impossible de te voler toi-même !", ephemeral=True)
+        await respond(interaction, "Impossible de te voler toi-même !", ephemeral=True)
         return
-    max_vols = await get_config("vols_max_per_day")
-    allowed = await check_quota(interaction.user.id, "vol", max_vols)
-    if not allowed:
-        await interaction.response.send_message("Tu as atteint le maximum de vols/jour.", ephemeral=True)
+    if await check_cooldown(interaction, "vol"):
         return
-    cible_balance = await get_balance(cible.id)
-    min_vol = await get_config("vol_min_amount")
-    max_vol = await get_config("vol_max_amount")
+    guild_id = interaction.guild_id
+    cible_balance = await get_balance(guild_id, cible.id)
+    # Au moins 1 : un vol de 0 (minimum configuré à 0) n'est pas un transfert
+    min_vol = max(get_config(guild_id, "vol_min_amount"), 1)
+    max_vol = get_config(guild_id, "vol_max_amount")
     if cible_balance < min_vol:
-        await interaction.response.send_message("La cible est trop pauvre pour être volée !", ephemeral=True)
+        await respond(interaction, "La cible est trop pauvre pour être volée !", ephemeral=True)
         return
     amount = random.randint(min_vol, min(max_vol, cible_balance))
-    await update_balance(interaction.user.id, amount)
-    await update_balance(cible.id, -amount)
-    await increment_quota(interaction.user.id, "vol")
+    max_vols = get_config(guild_id, "vols_max_per_day")
+    if await check_cooldown(interaction, "vol", claim=True):
+        return
+    try:
+        balances = await transfer(guild_id, cible.id, interaction.user.id, amount,
+                                  quota=(interaction.user.id, "vol", max_vols), action="vol", actor=interaction.user.id)
+    except QuotaExceeded:
+        cooldowns.cancel(guild_id, interaction.user.id, "vol")
+        await respond(interaction, "Tu as atteint le maximum de vols/jour.", ephemeral=True)
+        return
+    if balances is None:
+        cooldowns.cancel(guild_id, interaction.user.id, "vol")
+        await respond(interaction, "La cible est trop pauvre pour être volée !", ephemeral=True)
+        return
+    cible_balance, user_balance = balances
     embed = discord.Embed(
     title="🦹 VOL RÉUSSI !",
     description=f"Tu dérobes 🔥 **{amount}₽** à {cible.mention} !\n\n💀 Mauvaise journée pour {cible.mention}...",
     color=0xC0392B
     )
     embed.set_thumbnail(url="https://media.tenor.com/gKxMfe9o3PoAAAAd/robbery-robber.gif")
-    embed.add_field(name="Solde de la cible", value=f"{cible.mention}: **{cible_balance-amount}₽**", inline=False)
-    embed.add_field(name="Ton nouveau solde", value=f"{interaction.user.mention}: **{await get_balance(interaction.user.id)}₽**", inline=False)
+    embed.add_field(name="Solde de la cible", value=f"{cible.mention}: **{cible_balance}₽**", inline=False)
+    embed.add_field(name="Ton nouveau solde", value=f"{interaction.user.mention}: **{user_balance}₽**", inline=False)
     embed.set_footer(text="La criminalité paie... parfois.", icon_url=cible.avatar.url if cible.avatar else None)
-    await interaction.response.send_message(embed=embed)
+    await respond(interaction, embed=embed)
 
 
 
 @tree.command(name="echanger", description="Échanger de l'argent avec une personne")
+@app_commands.guild_only()
+@instrument
 async def echanger(interaction: discord.Interaction, cible: discord.User, montant: int):
     if montant <= 0:
-        await interaction.response.send_message("Le montant doit être positif.", ephemeral=True)
+        await respond(interaction, "Le montant doit être positif.", ephemeral=True)
         return
-    max_echanges = await get_config("echanges_max_per_day")
-    allowed = await check_quota(interaction.user.id, "echange", max_echanges)
-    if not allowed:
-        await interaction.response.send_message("Tu as atteint la limite d'échanges aujourd'hui.", ephemeral=True)
+    if await check_cooldown(interaction, "echange"):
         return
-    max_money_echange = await get_config("echange_max_amount")
+    guild_id = interaction.guild_id
+    max_money_echange = get_config(guild_id, "echange_max_amount")
     if montant > max_money_echange:
-        await interaction.response.send_message(f"Max par échange : {max_money_echange}€.", ephemeral=True)
+        await respond(interaction, f"Max par échange : {max_money_echange}€.", ephemeral=True)
         return
-    balance = await get_balance(interaction.user.id)
-    if balance < montant:
-        await interaction.response.send_message("Fonds insuffisants.", ephemeral=True)
+    max_echanges = get_config(guild_id, "echanges_max_per_day")
+    if await check_cooldown(interaction, "echange", claim=True):
         return
-    await update_balance(interaction.user.id, -montant)
-    await update_balance(cible.id, montant)
-    await increment_quota(interaction.user.id, "echange")
+    try:
+        balances = await transfer(guild_id, interaction.user.id, cible.id, montant,
+                                  quota=(interaction.user.id, "echange", max_echanges), action="echange",
+                                  actor=interaction.user.id)
+    except QuotaExceeded:
+        cooldowns.cancel(guild_id, interaction.user.id, "echange")
+        await respond(interaction, "Tu as atteint la limite d'échanges aujourd'hui.", ephemeral=True)
+        return
+    if balances is None:
+        cooldowns.cancel(guild_id, interaction.user.id, "echange")
+        await respond(interaction, "Fonds insuffisants.", ephemeral=True)
+        return
+    user_balance, cible_balance = balances
     embed = discord.Embed(
     title="🔄 Transaction réussie !",
     description=f"{interaction.user.mention} a transféré **{montant}₽** à {cible.mention}.\n🤝 Merci pour l’échange !",
     color=0x00CED1
     )
     embed.set_thumbnail(url="https://media.discordapp.net/attachments/1065772841426444360/1149979816732076052/exchange.gif")
-    embed.add_field(name="Solde de l’émetteur", value=f"{interaction.user.mention}: **{await get_balance(interaction.user.id)}₽**", inline=True)
-    embed.add_field(name="Solde du récepteur", value=f"{cible.mention}: **{await get_balance(cible.id)}₽**", inline=True)
+    embed.add_field(name="Solde de l’émetteur", value=f"{interaction.user.mention}: **{user_balance}₽**", inline=True)
+    embed.add_field(name="Solde du récepteur", value=f"{cible.mention}: **{cible_balance}₽**", inline=True)
     embed.set_footer(text="Économie Discord", icon_url=interaction.user.avatar.url if interaction.user.avatar else None)
-    await interaction.response.send_message(embed=embed)
+    await respond(interaction, embed=embed)
+
+# Une page déjà affichée est resservie telle quelle pendant ce délai (boutons précédent/suivant en rafale)
+LEADERBOARD_PAGE_TTL = 30
+
+
+class LeaderboardView(discord.ui.View):
+    """
+    Classement paginé pour un seul joueur : chaque page est construite au clic,
+    à partir des clés (-solde, id) de la page affichée, puis gardée LEADERBOARD_PAGE_TTL secondes.
+    """
+
+    def __init__(self, board, viewer_id):
+        super().__init__(timeout=120)
+        self.board = board
+        self.viewer_id = viewer_id
+        self.first = self.last = None
+        self._pages = {}
+
+    def _position(self, embed):
+        rank = self.board.rank(self.viewer_id)
+        if rank is not None:
+            embed.add_field(name="📍 Ta position",
+                            value=f"#{rank} sur {len(self.board.keys)} — {self.board.balances[self.viewer_id]}€",
+                            inline=False)
+        return embed
+
+    def _set_page(self, start, rows):
+        self.first, self.last = (rows[0], rows[-1]) if rows else (None, None)
+        self.previous.disabled = start == 0
+        self.next.disabled = start + len(rows) >= len(self.board.keys)
+
+    def first_page(self):
+        rows = self.board.keys[:self.board.size]
+        self._set_page(0, rows)
+        return self._position(self.board.embed())
+
+    async def _show(self, interaction, direction, cursor):
+        key = (direction, cursor)
+        now = time.monotonic()
+        cached = self._pages.get(key)
+        if cached is None or cached[0] < now:
+            start, rows = self.board.page_before(cursor) if direction == "prev" else self.board.page_after(cursor)
+            cached = self._pages[key] = (now + LEADERBOARD_PAGE_TTL, start, rows,
+                                         self._position(self.board.page_embed(start, rows)))
+        _, start, rows, embed = cached
+        self._set_page(start, rows)
+        await interaction.response.edit_message(embed=embed, view=self)
+
+    @discord.ui.button(emoji="◀️", style=discord.ButtonStyle.secondary)
+    async def previous(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, "prev", self.first)
+
+    @discord.ui.button(emoji="▶️", style=discord.ButtonStyle.secondary)
+    async def next(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, "next", self.last)
+
+    async def interaction_check(self, interaction):
+        if interaction.user.id != self.viewer_id:
+            await respond(interaction, "Lance ton propre /classement pour naviguer.", ephemeral=True)
+            return False
+        return True
+
 
 @tree.command(name="classement", description="Classement des plus riches")
+@app_commands.guild_only()
+@instrument
 async def classement(interaction: discord.Interaction):
-    async with aiosqlite.connect("eco.db") as db:
-        cursor = await db.execute("SELECT id, balance FROM users ORDER BY balance DESC LIMIT 10")
-        rows = await cursor.fetchall()
-    desc = ""
-    for idx, (uid, bal) in enumerate(rows, 1):
-        desc += f"{idx}. <@{uid}> — {bal}€\n"
-    embed = discord.Embed(
-    title="🏆 CLASSEMENT DES RICHES",
-    description="**Top 10 des joueurs les plus fortunés :**\n\n" + desc,
-    color=0x2ECC71
-    )
-    embed.set_thumbnail(url="https://media.discordapp.net/attachments/1065772841426444360/1149979817055051847/leaderboard.gif")
-    embed.set_footer(text=f"Actualisé le {datetime.now().strftime('%d/%m/%Y %H:%M')}", icon_url=None)
-    await interaction.response.send_message(embed=embed)
+    view = LeaderboardView(get_leaderboard(interaction.guild_id), interaction.user.id)
+    await respond(interaction, embed=view.first_page(), view=view)
 
 
 # --------- ADMIN CONFIG UI EN CATÉGORIES ---------
+CATEGORY_EMOJIS = {"Daily": "🎁", "Vol": "🦹", "Échange": "🔄"}
+
+# Parties fixes des panneaux, construites une fois au chargement : chaque appel ne fait plus que
+# Embed.from_dict avec le pied de page ou les valeurs courantes (les listes partagées ne sont jamais modifiées)
+CONFIG_PANEL = discord.Embed(
+    title="⚙️ Panneau d’administration économie",
+    description="Choisissez une catégorie à modifier :",
+    color=0x9147FF
+).set_thumbnail(url="https://cdn-icons-png.flaticon.com/512/924/924915.png")
+for _cat in CATEGORIES:
+    CONFIG_PANEL.add_field(name=f"{CATEGORY_EMOJIS.get(_cat, '⚙️')} {_cat.upper()}",
+                           value="Clique sur le bouton pour personnaliser.", inline=False)
+CONFIG_PANEL = CONFIG_PANEL.to_dict()
+
+CATEGORY_PANELS = {
+    cat: discord.Embed(
+        title=f"{cat} • Configuration",
+        description=(
+            f"**Paramètres modifiables pour {cat}**\n"
+            "Modifie facilement chaque paramètre grâce aux boutons ci-dessous.\n"
+            "• Les durées sont affichées en unités humaines.\n"
+            "• Les montants sont indiqués en € (ou monnaie de ton serveur).\n"
+        ),
+        color={"Daily": 0xF1C40F, "Vol": 0xC0392B, "Échange": 0x00CED1}[cat]
+    ).set_thumbnail(url={
+        "Daily": "https://cdn-icons-png.flaticon.com/512/481/481144.png",
+        "Vol": "https://cdn-icons-png.flaticon.com/512/1674/1674291.png",
+        "Échange": "https://cdn-icons-png.flaticon.com/512/1041/1041907.png"
+    }[cat]).to_dict()
+    for cat in CATEGORIES
+}
+
+# Suggestion personnalisée
+PARAM_SUGGESTIONS = {
+    "daily_amount": "💡 Conseillé: 50-200 €/jour.",
+    "vol_max_amount": "💡 Max vol conseillé : < 500.",
+    "echange_max_amount": "💡 Pour éviter l'abus, limitez à 500-1000€/échange."
+}
+
+def _param_field(param, value):
+    # Indications plus précises par paramètre
+    if "cooldown" in param:
+        val = human_duration(value)
+        typeinfo = "⏱ **Délai** (ex: 1h30m, 2j)."
+    elif "amount" in param:
+        val = f"{value} €"
+        typeinfo = "💰 **Montant** (en €)."
+    elif "max" in param or "min" in param:
+        val = str(value)
+        typeinfo = "🔢 **Limite**."
+    else:
+        val = str(value)
+        typeinfo = ""
+    return {"name": f"🔹 {param.replace('_',' ').title()}",
+            "value": f"`{val}`\n{typeinfo}\n{PARAM_SUGGESTIONS.get(param, '')}",
+            "inline": False}
 
 class ConfigView(discord.ui.View):
     def __init__(self, cur_config):
@@ -302,56 +2411,15 @@ class CategoryButton(discord.ui.Button):
 
     async def callback(self, interaction: discord.Interaction):
         cat = self.custom_id
-        cur_config = {p: await get_config(p) for p in CATEGORIES[cat]}
-        embed = discord.Embed(
-            title=f"{cat} • Configuration",
-            description=(
-                f"**Paramètres modifiables pour {cat}**\n"
-                "Modifie facilement chaque paramètre grâce aux boutons ci-dessous.\n"
-                "• Les durées sont affichées en unités humaines.\n"
-                "• Les montants sont indiqués en € (ou monnaie de ton serveur).\n"
-            ),
-            color={"Daily": 0xF1C40F, "Vol": 0xC0392B, "Échange": 0x00CED1}[cat]
-        )
-        embed.set_thumbnail(url={
-            "Daily": "https://cdn-icons-png.flaticon.com/512/481/481144.png",
-            "Vol": "https://cdn-icons-png.flaticon.com/512/1674/1674291.png",
-            "Échange": "https://cdn-icons-png.flaticon.com/512/1041/1041907.png"
-        }[cat])
-        for param in CATEGORIES[cat]:
-            # Indications plus précises par paramètre
-            if "cooldown" in param:
-                val = human_duration(cur_config[param])
-                typeinfo = "⏱ **Délai** (ex: 1h30m, 2j)."
-            elif "amount" in param:
-                val = f"{cur_config[param]} €"
-                typeinfo = "💰 **Montant** (en €)."
-            elif "max" in param or "min" in param:
-                val = str(cur_config[param])
-                typeinfo = "🔢 **Limite**."
-            else:
-                val = str(cur_config[param])
-                typeinfo = ""
-            # Suggestion personnalisée
-            suggestions = {
-                "daily_amount": "💡 Conseillé: 50-200 €/jour.",
-                "vol_max_amount": "💡 Max vol conseillé : < 500.",
-                "echange_max_amount": "💡 Pour éviter l'abus, limitez à 500-1000€/échange."
-            }
-            fieldtext = (
-                f"`{val}`\n"
-                f"{typeinfo}\n"
-                f"{suggestions.get(param, '')}"
-            )
-            embed.add_field(
-                name=f"🔹 {param.replace('_',' ').title()}",
-                value=fieldtext,
-                inline=False
-            )
+        cur_config = get_configs(interaction.guild_id, CATEGORIES[cat])
+        embed = discord.Embed.from_dict({
+            **CATEGORY_PANELS[cat],
+            "fields": [_param_field(param, cur_config[param]) for param in CATEGORIES[cat]],
+        })
         param_view = discord.ui.View()
         for param in CATEGORIES[cat]:
             param_view.add_item(ParamButton(cat, param, cur_config[param]))
-        await interaction.response.send_message(embed=embed, view=param_view, ephemeral=True)
+        await respond(interaction, embed=embed, view=param_view, ephemeral=True)
 
 class ParamButton(discord.ui.Button):
     def __init__(self, cat, param, value):
@@ -370,12 +2438,7 @@ class CategoryMenu(discord.ui.View):
     def __init__(self):
         super().__init__(timeout=120)
         for cat in CATEGORIES:
-            emoji = {
-                "Daily": "🎁",
-                "Vol": "🦹",
-                "Échange": "🔄"
-            }.get(cat, "⚙️")
-            self.add_item(CategoryButton(cat, emoji))
+            self.add_item(CategoryButton(cat, CATEGORY_EMOJIS.get(cat, "⚙️")))
 
     async def interaction_check(self, interaction):
         return interaction.user.guild_permissions.administrator
@@ -408,7 +2471,7 @@ class ConfigModal(discord.ui.Modal, title="🔧 Configuration rapide"):
         if "cooldown" in self.param:
             seconds = parse_duration(entry)
             if seconds <= 0:
-                await interaction.response.send_message(
+                await respond(interaction, 
                     "❗ Format de durée invalide (ex : 30m, 2h, 1j)", ephemeral=True)
                 return
             final_value = seconds
@@ -420,11 +2483,11 @@ class ConfigModal(discord.ui.Modal, title="🔧 Configuration rapide"):
                 if "amount" in self.param:
                     text_val += " €"
             except ValueError:
-                await interaction.response.send_message(
+                await respond(interaction, 
                     "❗ Valeur non valide : doit être un nombre", ephemeral=True)
                 return
 
-        await set_config(self.param, final_value)
+        await set_config(interaction.guild_id, self.param, final_value)
         explanations = {
             "daily_cooldown": "Le délai daily est lisible et simple à saisir ! (ex : 1h, 1j...)",
         }
@@ -438,92 +2501,439 @@ class ConfigModal(discord.ui.Modal, title="🔧 Configuration rapide"):
             color=0x27AE60
         )
         confirm.set_footer(text="Configuration actualisée ✨")
-        await interaction.response.send_message(embed=confirm, ephemeral=True)
+        await respond(interaction, embed=confirm, ephemeral=True)
 
 @tree.command(name="config", description="Configuration avancée économie")
+@app_commands.guild_only()
 @app_commands.default_permissions(administrator=True)
+@instrument
 async def config(interaction: discord.Interaction):
-    embed = discord.Embed(
-        title="⚙️ Panneau d’administration économie",
-        description="Choisissez une catégorie à modifier :",
-        color=0x9147FF
-    )
-    embed.set_thumbnail(url="https://cdn-icons-png.flaticon.com/512/924/924915.png")
-    embed.set_footer(text="Géré par " + interaction.user.display_name,
-                     icon_url=interaction.user.avatar.url if interaction.user.avatar else None)
-    for cat in CATEGORIES:
-        emoji = {"Daily": "🎁", "Vol": "🦹", "Échange": "🔄"}.get(cat, "⚙️")
-        embed.add_field(name=f"{emoji} {cat.upper()}",
-                        value=f"Clique sur le bouton pour personnaliser.", inline=False)
+    embed = discord.Embed.from_dict(CONFIG_PANEL).set_footer(
+        text="Géré par " + interaction.user.display_name,
+        icon_url=interaction.user.avatar.url if interaction.user.avatar else None)
     view = CategoryMenu()
-    await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
+    await respond(interaction, embed=embed, view=view, ephemeral=True)
 
 @tree.command(name="giveaway", description="pour donner des coins a une personne")
+@app_commands.guild_only()
 @app_commands.default_permissions(administrator=True)
+@instrument
 async def money(interaction: discord.Interaction, cible : discord.User, montant: int):
+    if montant <= 0:
+        await respond(interaction, "Le montant doit être positif.", ephemeral=True)
+        return
     embed = discord.Embed(
         title="🎁 Récompense donné",
         description=f"Montant donné : **{montant}**",
         color=0x9147FF
     )
-    await update_balance(interaction.user.id, -montant)
-    await update_balance(cible.id, montant)
-    await increment_quota(interaction.user.id, "giveaway")
-    await interaction.response.send_message(embed=embed)
+    await transfer(interaction.guild_id, interaction.user.id, cible.id, montant,
+                   quota=(interaction.user.id, "giveaway", None), require_funds=False,
+                   action="giveaway", actor=interaction.user.id)
+    await respond(interaction, embed=embed)
 
 @tree.command(name="remove", description="Retire des coins à un utilisateur")
+@app_commands.guild_only()
 @app_commands.default_permissions(administrator=True)
+@instrument
 async def remove(interaction: discord.Interaction, cible: discord.User, montant: int):
-    solde = await get_balance(cible.id)
+    # Le solde vérifié est celui qui est débité : aucun vol ni échange ne passe entre les deux
+    async with user_locks.hold(interaction.guild_id, cible.id):
+        solde = await get_balance(interaction.guild_id, cible.id)
+        if montant <= solde:
+            await update_balance(interaction.guild_id, cible.id, -montant, action="remove", actor=interaction.user.id)
     if montant > solde:
         embed = discord.Embed(
             title="⛔ Impossible",
             description=f"{cible.mention} n’a que **{solde}** coins, impossible de retirer **{montant}**.",
             color=0xFF0000
         )
-        await interaction.response.send_message(embed=embed, ephemeral=True)
+        await respond(interaction, embed=embed, ephemeral=True)
         return
-    await update_balance(cible.id, -montant)
     embed = discord.Embed(
         title="💸 Coins retirés",
         description=f"**{montant}** coins retirés à {cible.mention}. Nouveau solde : **{solde - montant}**.",
         color=0xFF9147
     )
-    await interaction.response.send_message(embed=embed)
+    await respond(interaction, embed=embed)
 
 @tree.command(name="reset", description="Remet le solde d'un utilisateur à zéro")
+@app_commands.guild_only()
 @app_commands.default_permissions(administrator=True)
+@instrument
 async def reset(interaction: discord.Interaction, cible: discord.User):
-    solde = await get_balance(cible.id)
+    async with user_locks.hold(interaction.guild_id, cible.id):
+        solde = await get_balance(interaction.guild_id, cible.id)
+        if solde:
+            await update_balance(interaction.guild_id, cible.id, -solde, action="reset", actor=interaction.user.id)
     if solde == 0:
         embed = discord.Embed(
             title="🔄 Solde déjà à zéro",
             description=f"{cible.mention} a déjà un solde de **0**.",
             color=0x9147FF
         )
-        await interaction.response.send_message(embed=embed)
+        await respond(interaction, embed=embed)
         return
-    await update_balance(cible.id, -solde)
     embed = discord.Embed(
         title="🔄 Solde réinitialisé",
         description=f"Le solde de {cible.mention} vient d’être réinitialisé à **0**.",
         color=0xFF4949
     )
-    await interaction.response.send_message(embed=embed)
+    await respond(interaction, embed=embed)
+
+@tree.command(name="verifier", description="Rejoue le journal des transactions et compare avec les soldes")
+@app_commands.guild_only()
+@app_commands.default_permissions(administrator=True)
+@instrument
+async def verifier(interaction: discord.Interaction, corriger: bool = False):
+    mismatches = await replay_ledger(interaction.guild_id, fix=corriger)
+    if not mismatches:
+        embed = discord.Embed(
+            title="✅ Journal cohérent",
+            description="Tous les soldes correspondent au journal des transactions.",
+            color=0x27AE60
+        )
+        await respond(interaction, embed=embed, ephemeral=True)
+        return
+    lines = "\n".join(f"<@{uid}> — journal **{expected}**, solde **{actual}**" for uid, expected, actual in mismatches[:10])
+    if len(mismatches) > 10:
+        lines += f"\n… et {len(mismatches) - 10} autres"
+    embed = discord.Embed(
+        title="🛠️ Soldes corrigés" if corriger else "⚠️ Écarts détectés",
+        description=f"**{len(mismatches)}** solde(s) diffèrent du journal :\n\n{lines}",
+        color=0x27AE60 if corriger else 0xFF9147
+    )
+    await respond(interaction, embed=embed, ephemeral=True)
+
+def _bulk_embed(op, rows, title, color, elapsed=None):
+    delta = sum(new - old for _, old, new in rows)
+    embed = discord.Embed(
+        title=f"{BULK_OPERATIONS[op]} groupé • {title}",
+        description=f"**{len(rows)}** cible(s) · variation totale **{delta:+}** coins",
+        color=color
+    )
+    sample = "\n".join(f"<@{uid}> : {old} → **{new}**" for uid, old, new in rows[:10])
+    if len(rows) > 10:
+        sample += f"\n… et {len(rows) - 10} autres"
+    embed.add_field(name="Détail", value=sample or "—", inline=False)
+    if elapsed is not None:
+        embed.set_footer(text=f"Appliqué en une transaction ({elapsed * 1000:.0f} ms)")
+    return embed
 
+@tree.command(name="masse", description="Giveaway, retrait ou remise à zéro pour un rôle, une liste ou un seuil")
+@app_commands.guild_only()
+@app_commands.default_permissions(administrator=True)
+@app_commands.describe(
+    operation="Opération à appliquer à chaque cible",
+    montant="Montant par cible (ignoré pour la remise à zéro)",
+    role="Tous les membres de ce rôle",
+    membres="Liste de mentions ou d'identifiants",
+    seuil="Tous les joueurs ayant au moins ce solde",
+    apercu="Afficher les totaux sans rien appliquer"
+)
+@app_commands.choices(operation=[
+    app_commands.Choice(name="Giveaway", value="giveaway"),
+    app_commands.Choice(name="Retrait", value="remove"),
+    app_commands.Choice(name="Remise à zéro", value="reset"),
+])
+@instrument
+async def masse(interaction: discord.Interaction, operation: app_commands.Choice[str], montant: int = 0,
+                role: discord.Role = None, membres: str = None, seuil: int = None, apercu: bool = False):
+    op = operation.value
+    if op != "reset" and montant <= 0:
+        await respond(interaction, "Le montant doit être positif.", ephemeral=True)
+        return
+    if role is not None and not intents.members:
+        await respond(interaction, "Cibler un rôle demande l'intent membres (ECO_MEMBERS_INTENT=1).", ephemeral=True)
+        return
+    guild_id = interaction.guild_id
+    targets = resolve_targets(guild_id, role, membres, seuil)
+    if not targets:
+        await respond(interaction, "Aucune cible : indique un rôle, des membres ou un seuil.", ephemeral=True)
+        return
+    if apercu:
+        embed = _bulk_embed(op, bulk_preview(guild_id, targets, op, montant), "Aperçu", 0x9147FF)
+        await respond(interaction, embed=embed, ephemeral=True)
+        return
+    await respond(interaction, embed=_bulk_embed(op, bulk_preview(guild_id, targets, op, montant), "⏳ En cours…", 0xF1C40F))
+    start = time.perf_counter()
+    rows = await bulk_apply(guild_id, targets, op, montant, actor=interaction.user.id)
+    elapsed = time.perf_counter() - start
+    await interaction.edit_original_response(embed=_bulk_embed(op, rows, "✅ Terminé", 0x27AE60, elapsed))
 
-from flask import Flask
 
-app = Flask(__name__)
+@tree.command(name="export", description="Exporte l'économie du serveur (soldes, config, quotas, journal)")
+@app_commands.guild_only()
+@app_commands.default_permissions(administrator=True)
+@app_commands.describe(journal="Inclure l'historique des transactions (fichier plus gros)")
+@instrument
+async def export(interaction: discord.Interaction, journal: bool = False):
+    await respond(interaction, "⏳ Export en cours…", ephemeral=True)
+    guild_id = interaction.guild_id
+    fd, dest = tempfile.mkstemp(suffix=".ndjson.gz")
+    os.close(fd)
+    try:
+        start = time.perf_counter()
+        counts = await export_guild(guild_id, dest, journal=journal)
+        elapsed = time.perf_counter() - start
+        size = os.path.getsize(dest)
+        summary = ", ".join(f"{table} {count}" for table, count in counts.items())
+        if size > interaction.guild.filesize_limit:
+            await interaction.edit_original_response(
+                content=f"⛔ Export trop gros pour Discord ({size // 1024} Ko) : utiliser `python coin.py export {guild_id}`.")
+            return
+        name = f"eco-{guild_id}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.ndjson.gz"
+        await interaction.edit_original_response(
+            content=f"📦 Export terminé en {elapsed:.2f}s ({size // 1024} Ko) : {summary}\n"
+                    f"Import : `python coin.py import {name}` (bot arrêté).",
+            attachments=[discord.File(dest, filename=name)])
+    finally:
+        os.remove(dest)
 
-@app.route('/')
-def home():
-    return 'Bot is running!'
 
-if __name__ == '__main__':
-    app.run()
+@tree.command(name="stats", description="Latences et activité base de données par commande")
+@app_commands.guild_only()
+@app_commands.default_permissions(administrator=True)
+@instrument
+async def stats(interaction: discord.Interaction):
+    embed = discord.Embed(
+        title="📊 Statistiques des commandes",
+        description=f"Délai Discord : **{INTERACTION_DEADLINE:.0f}s** avant expiration d'une interaction.",
+        color=0x9147FF
+    )
+    for name, hist in sorted(metrics.durations.items()):
+        calls = metrics.count("eco_commands_total", name) or 1
+        response = metrics.responses.get(name)
+        embed.add_field(
+            name=f"/{name} — {hist.total} appels",
+            value=(
+                f"Durée p50 **{hist.quantile(0.5) * 1000:.1f} ms** · p99 **{hist.quantile(0.99) * 1000:.1f} ms**\n"
+                f"1ʳᵉ réponse p99 : {(response.quantile(0.99) if response else 0) * 1000:.1f} ms\n"
+                f"Requêtes/appel : {metrics.count('eco_db_statements_total', name) / calls:.1f} · "
+                f"commits/appel : {metrics.count('eco_db_commits_total', name) / calls:.2f}\n"
+                f"Erreurs : {metrics.count('eco_command_errors_total', name)} · "
+                f"hors délai : {metrics.count('eco_command_over_deadline_total', name)}\n"
+                f"Différées : {metrics.count('eco_responses_deferred_total', name)} · "
+                f"limitées : {metrics.count('eco_responses_limited_total', name)}"
+            ),
+            inline=False
+        )
+    embed.set_footer(text=f"Commits en arrière-plan : {metrics.count('eco_db_commits_total', 'arriere_plan')}")
+    await respond(interaction, embed=embed, ephemeral=True)
+
+
+# --------- SERVEUR HTTP (keep-alive, santé, métriques) ----------
+# Flask et werkzeug ne sont importés qu'au lancement du serveur (create_app) : les commandes CLI et le banc s'en passent
+HTTP_HOST = os.getenv("HTTP_HOST", "0.0.0.0")
+HTTP_PORT = int(os.getenv("PORT", "8080"))
+HEALTH_MAX_LOOP_LAG = 1.0
+
+# Boucle du bot, pour que les routes HTTP (autre thread) puissent y interroger la base
+_bot_loop = None
+
+def health_report():
+    latency = bot.latency
+    gateway_ok = bot.is_ready() and math.isfinite(latency)
+    db_ok = False
+    if db.is_open and _bot_loop is not None:
+        try:
+            asyncio.run_coroutine_threadsafe(db.fetchone("SELECT 1"), _bot_loop).result(timeout=1)
+            db_ok = True
+        except Exception:
+            db_ok = False
+    loop_ok = loop_monitor.lag < HEALTH_MAX_LOOP_LAG
+    return {
+        "status": "ok" if gateway_ok and db_ok and loop_ok else "degraded",
+        "gateway_latency_ms": round(latency * 1000, 1) if math.isfinite(latency) else None,
+        "db": {
+            "open": db.is_open,
+            "ok": db_ok,
+            "readers_idle": db._pool.qsize() if db.is_open else 0,
+            "readers": db.readers,
+            "ledger_queue": len(ledger.queue),
+            "guild_files": len(guild_dbs),
+        },
+        "guilds_open": len(_open_guilds),
+        "responses": {
+            "deferred": metrics.total("eco_responses_deferred_total"),
+            "limited": metrics.total("eco_responses_limited_total"),
+            "rate_buckets": len(response_limiter.buckets),
+        },
+        "shards": {str(shard_id): round(lat * 1000, 1) if math.isfinite(lat) else None
+                   for shard_id, lat in bot.latencies},
+        "event_loop_lag_ms": round(loop_monitor.lag * 1000, 1),
+        "event_loop_lag_max_ms": round(loop_monitor.max_lag * 1000, 1),
+    }
+
+def create_app():
+    from flask import Flask, Response, jsonify
+
+    app = Flask(__name__)
+
+    @app.route('/')
+    def home():
+        return 'Bot is running!'
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+    @app.route('/healthz')
+    def healthz():
+        body = health_report()
+        return jsonify(body), 200 if body["status"] == "ok" else 503
+
+    return app
+
+
+class HttpServer:
+    """Serveur WSGI sur un seul thread de fond : ne bloque jamais la boucle du bot."""
+
+    def __init__(self, host=HTTP_HOST, port=HTTP_PORT):
+        from werkzeug.serving import make_server
+        self.server = make_server(host, port, create_app(), threaded=False)
+        self.thread = threading.Thread(target=self.server.serve_forever, name="http", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        print(f"HTTP : écoute sur {self.server.host}:{self.server.port}")
+
+    def stop(self):
+        self.server.shutdown()
+        self.thread.join(timeout=5)
 
 
 # --------- LANCEMENT BOT ---------
-bot.run(os.getenv(Token))
+async def run_bot(token):
+    global _bot_loop
+    _bot_loop = asyncio.get_running_loop()
+    loop_monitor.start()
+    backups.start()
+    http = HttpServer()
+    http.start()
+    startup.mark("http")
+    # SIGTERM (arrêt de l'hébergeur) et Ctrl+C : fermeture propre, caches vidés en base
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            _bot_loop.add_signal_handler(sig, lambda: asyncio.create_task(bot.close()))
+        except NotImplementedError:
+            pass
+    try:
+        async with bot:
+            await bot.start(token)
+    finally:
+        backups.stop()
+        await close_economy()
+        http.stop()
+        loop_monitor.stop()
+        executor.shutdown(wait=False)
+        print("Arrêt terminé")
 
+async def run_verify_ledger(fix):
+    await open_economy()
+    mismatches = []
+    try:
+        for guild_id in await known_guilds():
+            await open_guild(guild_id)
+            for uid, expected, actual in await replay_ledger(guild_id, fix=fix):
+                print(f"[{guild_id}] {uid} : journal {expected}, solde {actual}")
+                mismatches.append(uid)
+    finally:
+        await close_economy()
+    print(f"{len(mismatches)} écart(s)" + (" corrigé(s)" if fix and mismatches else ""))
+    return 1 if mismatches and not fix else 0
+
+async def run_backup():
+    await backups.run_once()
+    executor.shutdown()
+    return 0
+
+def run_restore(archive, path=None):
+    if path is None:
+        # eco-AAAAMMJJ-HHMMSSffffff.db.gz -> ECO_DB ; <guild_id>-....db.gz -> base de ce serveur
+        stem = os.path.basename(archive).split("-")[0]
+        path = os.path.join(GUILD_DB_DIR, f"{stem}.db") if stem.isdigit() else DB_PATH
+    if os.path.exists(path):
+        archive_before, *_ = _backup_file(path, BACKUP_DIR)
+        print(f"État actuel de {path} sauvegardé dans {archive_before}")
+    try:
+        _restore_file(archive, path)
+    except (ValueError, sqlite3.DatabaseError) as e:
+        print(f"Restauration annulée : {e}")
+        return 1
+    print(f"{path} restauré depuis {archive}")
+    return 0
+
+async def run_export(guild_id, dest=None, journal=True):
+    dest = dest or f"eco-{guild_id}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.ndjson.gz"
+    await open_economy()
+    try:
+        await open_guild(guild_id)
+        start = time.perf_counter()
+        counts = await export_guild(guild_id, dest, journal=journal)
+    finally:
+        await close_economy()
+        executor.shutdown()
+    summary = ", ".join(f"{table} {count}" for table, count in counts.items())
+    print(f"Export de {guild_id} dans {dest} en {time.perf_counter() - start:.2f}s ({os.path.getsize(dest) // 1024} Ko) : {summary}")
+    return 0
+
+async def run_import(archive, guild_id=None):
+    try:
+        header = _read_export_header(archive)
+    except (ValueError, OSError, EOFError) as e:
+        print(f"Import annulé : {e}")
+        return 1
+    guild_id = guild_id or header["guild_id"]
+    await open_economy()
+    try:
+        # Crée et migre la base du serveur si besoin, avant l'écriture directe par sqlite3
+        await open_guild(guild_id)
+        start = time.perf_counter()
+        counts = await offload(_import_file, guild_db(guild_id).path, archive, guild_id)
+    except (ValueError, OSError, EOFError, sqlite3.Error) as e:
+        print(f"Import annulé, base inchangée : {e}")
+        return 1
+    finally:
+        await close_economy()
+        executor.shutdown()
+    summary = ", ".join(f"{table} {count}" for table, count in counts.items())
+    print(f"Import de {archive} dans le serveur {guild_id} en {time.perf_counter() - start:.2f}s : {summary}")
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Bot économie Discord")
+    sub = parser.add_subparsers(dest="command")
+    sub.add_parser("run", help="lance le bot et le serveur HTTP (par défaut)")
+    verify = sub.add_parser("verify-ledger", help="rejoue le journal et compare avec les soldes")
+    verify.add_argument("--fix", action="store_true", help="réécrit les soldes divergents")
+    sub.add_parser("backup", help="sauvegarde immédiate de toutes les bases dans ECO_BACKUP_DIR")
+    restore = sub.add_parser("restore", help="restaure une archive .db.gz (bot arrêté)")
+    restore.add_argument("archive")
+    restore.add_argument("--db", help="base à remplacer (déduite du nom de l'archive par défaut)")
+    export_cmd = sub.add_parser("export", help="exporte un serveur en NDJSON gzip")
+    export_cmd.add_argument("guild_id", type=int)
+    export_cmd.add_argument("-o", "--output", help="fichier de sortie (eco-<serveur>-<date>.ndjson.gz par défaut)")
+    export_cmd.add_argument("--no-ledger", action="store_true", help="sans l'historique des transactions")
+    import_cmd = sub.add_parser("import", help="remplace les données d'un serveur par un export (bot arrêté)")
+    import_cmd.add_argument("archive")
+    import_cmd.add_argument("--guild", type=int, help="serveur cible (celui de l'export par défaut)")
+    args = parser.parse_args()
+    startup.mark("imports")
+    if args.command == "verify-ledger":
+        sys.exit(asyncio.run(run_verify_ledger(args.fix)))
+    if args.command == "backup":
+        sys.exit(asyncio.run(run_backup()))
+    if args.command == "restore":
+        sys.exit(run_restore(args.archive, args.db))
+    if args.command == "export":
+        sys.exit(asyncio.run(run_export(args.guild_id, args.output, journal=not args.no_ledger)))
+    if args.command == "import":
+        sys.exit(asyncio.run(run_import(args.archive, args.guild)))
+    token = os.getenv("Token")
+    if not token:
+        sys.exit("Variable d'environnement Token manquante")
+    asyncio.run(run_bot(token))
+
+if __name__ == '__main__':
+    main()